@@ -3,25 +3,37 @@
 """
 
 import uvicorn
-from fastapi import FastAPI, HTTPException, Query, Body, Path, Depends
+from fastapi import FastAPI, HTTPException, Query, Body, Path, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, HTMLResponse, FileResponse
+from fastapi.responses import (
+    JSONResponse, HTMLResponse, FileResponse, ORJSONResponse, Response, StreamingResponse
+)
 from fastapi.staticfiles import StaticFiles
 from fastapi.openapi.docs import get_swagger_ui_html
 from contextlib import asynccontextmanager
 from typing import List, Dict, Any, Optional
 from datetime import datetime
+import asyncio
 import json
+import orjson
+import xxhash
 import logging
 import os
+import sys
+import time
 
 # 导入业务模块
 from database import db_manager
 from api_models import (
     TargetData, FormationResult, RecognitionRequest, RecognitionResponse,
-    HealthCheck, ApiResponse
+    HealthCheck, ApiResponse, to_soa, to_epoch_range
+)
+import api_models_fast
+from api_requests import (
+    parse_recognition_request, parse_target_list, RECOGNITION_OPENAPI, TARGET_LIST_OPENAPI
 )
 from formation_service import formation_service
+from cache.redis_client import redis_client, RedisConfig
 from api_rules import router as rules_router
 from api_cache import router as cache_router  # 新增缓存路由
 from scheduler.cleanup import cleanup_scheduler  # 新增清理调度器
@@ -34,12 +46,40 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 优先使用uvloop事件循环（libuv实现，Windows不支持）
+# 在模块导入时安装，gunicorn/uvicorn worker导入应用时同样生效
+if not sys.platform.startswith("win"):
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        logger.warning("uvloop未安装，使用默认asyncio事件循环")
+
+# 与ORJSONResponse一致的编码选项（用于流式响应逐条编码）
+_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+# 状态接口缓存（负载均衡器高频轮询，1秒内直接返回内存结果）
+_STATUS_CACHE_TTL = 1.0
+_health_cache = {"ts": 0.0, "payload": None}
+_ws_status_cache = {"ts": 0.0, "payload": None}
+
+# 粗粒度时钟（后台每100ms刷新一次，用于非关键时间戳）
+_CLOCK_INTERVAL = 0.1
+_NOW = [datetime.now()]
+
+
+async def _refresh_clock():
+    """刷新粗粒度时钟"""
+    while True:
+        _NOW[0] = datetime.now()
+        await asyncio.sleep(_CLOCK_INTERVAL)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """应用生命周期管理"""
     # 启动时
-    logger.info("服务启动中...")
+    logger.info("服务启动中... 事件循环: %s", type(asyncio.get_running_loop()).__module__)
 
     # 初始化数据库
     db_manager.init_database()
@@ -50,11 +90,25 @@ async def lifespan(app: FastAPI):
     # 启动定时清理任务
     cleanup_scheduler.start()
 
+    # 启动粗粒度时钟
+    clock_task = asyncio.create_task(_refresh_clock())
+
+    # 启动WebSocket事件总线（多worker共享推送）
+    websocket_manager.start_event_bus()
+    websocket_manager.start_flush_loop()
+
+    # 启动纯缓存写入合并任务
+    formation_service.start_cache_write_flusher()
+
     logger.info("服务启动完成，Redis缓存已启用")
     yield
 
     # 关闭时
     logger.info("服务关闭中...")
+    await formation_service.stop_cache_write_flusher()
+    clock_task.cancel()
+    await websocket_manager.stop_flush_loop()
+    await websocket_manager.stop_event_bus()
     cleanup_scheduler.shutdown()
     formation_service.cleanup()
     logger.info("服务已关闭")
@@ -92,13 +146,18 @@ app = FastAPI(
     version="3.0.0",
     docs_url=None,
     redoc_url=None,
+    default_response_class=ORJSONResponse,  # orjson序列化（支持numpy数组）
     lifespan=lifespan
 )
 
-# 配置CORS
+# 配置CORS（生产环境通过 ALLOWED_ORIGINS 指定逗号分隔的来源列表，未配置时允许全部）
+_ALLOWED_ORIGINS = [
+    origin.strip() for origin in os.getenv("ALLOWED_ORIGINS", "*").split(",") if origin.strip()
+]
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=_ALLOWED_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
@@ -111,10 +170,8 @@ if os.path.exists("static"):
 
 # ==================== 前端路由 ====================
 
-@app.get("/", response_class=HTMLResponse, tags=["前端"])
-async def index():
-    """Web管理界面入口"""
-    html_content = """
+# 管理界面页面（导入时编码一次，每次请求直接返回字节）
+_INDEX_HTML = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -182,7 +239,17 @@ async def index():
     </body>
     </html>
     """
-    return HTMLResponse(content=html_content)
+_INDEX_HTML_BYTES = _INDEX_HTML.encode("utf-8")
+
+
+@app.get("/", response_class=HTMLResponse, tags=["前端"])
+async def index():
+    """Web管理界面入口"""
+    return Response(
+        content=_INDEX_HTML_BYTES,
+        media_type="text/html",
+        headers={"Cache-Control": "public, max-age=300"}
+    )
 
 
 @app.get("/docs", tags=["文档"])
@@ -201,13 +268,23 @@ async def custom_swagger_ui():
 @app.get("/health", tags=["健康检查"], response_model=HealthCheck)
 async def health_check():
     """健康检查"""
+    now = time.monotonic()
+    if _health_cache["payload"] is None or now - _health_cache["ts"] > _STATUS_CACHE_TTL:
+        _health_cache["payload"] = await asyncio.to_thread(_build_health_check)
+        _health_cache["ts"] = now
+
+    return _health_cache["payload"]
+
+
+def _build_health_check() -> HealthCheck:
+    """构建健康检查结果（涉及Redis/数据库查询，在线程池中执行）"""
     cache_status = formation_service.get_cache_status()
 
     return HealthCheck(
         status="healthy",
         service="formation-recognition-api",
         version="3.0.0",
-        timestamp=datetime.now(),
+        timestamp=_NOW[0],
         details={
             "database": "connected",
             "redis": "connected" if cache_status.get("redis_connected") else "disconnected",
@@ -218,13 +295,46 @@ async def health_check():
     )
 
 
+# ==================== 识别结果去重缓存 ====================
+
+def _recognition_cache_key(targets: List[Dict], request: api_models_fast.RecognitionRequest) -> str:
+    """按请求内容计算缓存key（目标顺序无关）"""
+    h = xxhash.xxh3_128()
+    for item in sorted(orjson.dumps(t, option=orjson.OPT_SORT_KEYS) for t in targets):
+        h.update(item)
+    h.update(orjson.dumps(
+        [request.preset, request.scene_type, to_epoch_range(request.time_range)]
+    ))
+    # 一次性key直接拼接，不经过 _make_key 的LRU缓存（避免挤掉热点目标/编队key）
+    return f"{RedisConfig.KEY_PREFIX}cache:recognize:{h.hexdigest()}"
+
+
+def _get_cached_response(cache_key: str) -> Optional[bytes]:
+    """读取去重缓存的响应体（原始字节，不经过反序列化；Redis异常时视为未命中）"""
+    try:
+        return redis_client.client.get(cache_key)
+    except Exception as e:
+        logger.error(f"读取识别缓存失败: {e}")
+        return None
+
+
+def _store_cached_response(cache_key: str, body: bytes):
+    """写入去重缓存的响应体（原始字节，不经过序列化）"""
+    try:
+        redis_client.client.setex(cache_key, RedisConfig.RECOGNIZE_CACHE_TTL, body)
+    except Exception as e:
+        logger.error(f"写入识别缓存失败: {e}")
+
+
 # ==================== 编队识别核心接口（优化版） ====================
 
 @app.post("/recognize",
           tags=["编队识别"],
-          response_model=RecognitionResponse,
-          summary="执行编队识别（集成缓存）")
-async def recognize(request: RecognitionRequest):
+          response_model=None,
+          responses={200: {"model": RecognitionResponse}},
+          summary="执行编队识别（集成缓存）",
+          openapi_extra=RECOGNITION_OPENAPI)
+async def recognize(request: api_models_fast.RecognitionRequest = Depends(parse_recognition_request)):
     """
     执行编队识别（自动缓存目标状态，支持增量识别）
 
@@ -233,23 +343,35 @@ async def recognize(request: RecognitionRequest):
     - 识别结果自动存储7天
     """
     try:
-        logger.info(f"收到识别请求: {len(request.targets)}个目标")
+        logger.info("收到识别请求: %d个目标", len(request.targets))
+
+        targets = api_models_fast.to_builtins(request.targets)
+
+        # 相同内容的请求在短时间内直接返回缓存结果
+        cache_key = _recognition_cache_key(targets, request)
+        cached = await asyncio.to_thread(_get_cached_response, cache_key)
+        if cached is not None:
+            logger.info("识别请求命中去重缓存")
+            return Response(content=cached, media_type="application/json")
 
-        # 使用优化后的识别方法
-        result = formation_service.recognize(
-            targets=[t.dict() for t in request.targets],
+        # 使用优化后的识别方法（列式结构传入引擎）
+        result = await formation_service.arecognize(
+            targets=to_soa(request.targets),
             preset=request.preset,
             scene_type=request.scene_type,
-            time_range=request.time_range,
+            time_range=to_epoch_range(request.time_range),
             use_cache=True,  # 启用缓存
             incremental=False,  # 可根据需要改为True
             emit_events=True  # 发送WebSocket事件
         )
 
-        logger.info(f"识别完成: {result['formation_count']}个编队，"
-                    f"已缓存: {result.get('stored_formation_ids', [])}")
+        logger.info("识别完成: %d个编队，已缓存: %s",
+                    result['formation_count'], result.get('stored_formation_ids', []))
 
-        return RecognitionResponse(**result)
+        # 服务层结果直接编码返回，不再按RecognitionResponse重新校验（模型仅用于文档）
+        response = ORJSONResponse(content=result)
+        await asyncio.to_thread(_store_cached_response, cache_key, response.body)
+        return response
 
     except Exception as e:
         logger.error(f"识别失败: {str(e)}")
@@ -258,44 +380,113 @@ async def recognize(request: RecognitionRequest):
 
 @app.post("/recognize/incremental",
           tags=["编队识别"],
-          summary="增量编队识别")
-async def recognize_incremental(request: RecognitionRequest):
+          response_model=None,
+          responses={200: {"model": RecognitionResponse}},
+          summary="增量编队识别",
+          openapi_extra=RECOGNITION_OPENAPI)
+async def recognize_incremental(request: api_models_fast.RecognitionRequest = Depends(parse_recognition_request)):
     """
     增量编队识别（只处理有变化的目标）
 
     适用于高频数据流场景，减少重复计算
     """
     try:
-        result = formation_service.recognize(
-            targets=[t.dict() for t in request.targets],
+        result = await formation_service.arecognize(
+            targets=api_models_fast.to_builtins(request.targets),
             preset=request.preset,
             scene_type=request.scene_type,
-            time_range=request.time_range,
+            time_range=to_epoch_range(request.time_range),
             use_cache=True,
             incremental=True,  # 启用增量模式
             emit_events=True
         )
 
-        return RecognitionResponse(**result)
+        return ORJSONResponse(content=result)
 
     except Exception as e:
         logger.error(f"增量识别失败: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/recognize/stream",
+          tags=["编队识别"],
+          summary="执行编队识别（NDJSON流式返回）",
+          openapi_extra=RECOGNITION_OPENAPI)
+async def recognize_stream(request: api_models_fast.RecognitionRequest = Depends(parse_recognition_request)):
+    """
+    执行编队识别，结果按NDJSON逐行流式返回
+
+    - 每行一个编队（结构同 FormationResult），逐个编码发送，不整体缓冲
+    - 最后一行为识别摘要 {"summary": {...}}
+    - 适用于包含完整航迹的大结果
+    """
+    try:
+        result = await formation_service.arecognize(
+            targets=to_soa(request.targets),
+            preset=request.preset,
+            scene_type=request.scene_type,
+            time_range=to_epoch_range(request.time_range),
+            use_cache=True,
+            incremental=False,
+            emit_events=True
+        )
+    except Exception as e:
+        logger.error(f"识别失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def generate():
+        for formation in result["formations"]:
+            yield orjson.dumps(formation, option=_ORJSON_OPTIONS) + b"\n"
+
+        summary = {k: v for k, v in result.items() if k != "formations"}
+        yield orjson.dumps({"summary": summary}, option=_ORJSON_OPTIONS) + b"\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
+# ==================== 规则预设 ====================
+
+@app.get("/presets/{preset_id}", tags=["规则管理"], summary="获取预设详情（含规则）")
+def get_preset(request: Request, preset_id: str = Path(..., description="预设ID")):
+    """
+    获取预设详情（含规则）
+
+    响应带ETag（基于预设updated_at），客户端携带 If-None-Match 且未变更时返回304
+    """
+    session = db_manager.get_session()
+    try:
+        version = db_manager.get_preset_version(session, preset_id)
+    finally:
+        session.close()
+
+    if version is None:
+        raise HTTPException(status_code=404, detail=f"预设不存在: {preset_id}")
+
+    etag = f'W/"{preset_id}-{version}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
+    preset = db_manager.get_preset_dict(preset_id, version)
+    if preset is None:
+        raise HTTPException(status_code=404, detail=f"预设不存在: {preset_id}")
+
+    return ORJSONResponse(preset, headers={"ETag": etag})
+
+
 # ==================== 纯缓存接口（不触发识别） ====================
 
 @app.post("/cache-only",
           tags=["缓存"],
-          summary="仅缓存目标状态（不识别）")
-async def cache_only(targets: List[Dict] = Body(...)):
+          summary="仅缓存目标状态（不识别）",
+          openapi_extra=TARGET_LIST_OPENAPI)
+async def cache_only(targets: List[Dict] = Depends(parse_target_list)):
     """
     批量缓存目标状态，不执行编队识别
 
     用于外部系统同步数据到缓存，供后续查询或识别使用
     """
     try:
-        result = formation_service.cache_targets_only(targets)
+        result = await formation_service.acache_targets_only(targets)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -306,14 +497,20 @@ async def cache_only(targets: List[Dict] = Body(...)):
 @app.get("/ws/status", tags=["监控"])
 async def websocket_status():
     """WebSocket连接状态"""
-    return {
-        "active_connections": len(websocket_manager.active_connections),
-        "subscribed_targets": len(websocket_manager.target_subscriptions),
-        "client_subscriptions": {
-            cid: len(targets)
-            for cid, targets in websocket_manager.client_subscriptions.items()
+    now = time.monotonic()
+    if _ws_status_cache["payload"] is None or now - _ws_status_cache["ts"] > _STATUS_CACHE_TTL:
+        _ws_status_cache["payload"] = {
+            "active_connections": len(websocket_manager.active_connections),
+            "subscribed_targets": len(websocket_manager.target_subscriptions),
+            "event_bus_running": websocket_manager.event_bus_running,
+            "client_subscriptions": {
+                cid: len(targets)
+                for cid, targets in websocket_manager.client_subscriptions.items()
+            }
         }
-    }
+        _ws_status_cache["ts"] = now
+
+    return _ws_status_cache["payload"]
 
 
 # ==================== 注册路由 ====================
@@ -323,10 +520,23 @@ app.include_router(cache_router)  # 注册缓存路由
 
 # 启动入口
 if __name__ == "__main__":
-    uvicorn.run(
-        "main:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True,
-        log_level="info"
-    )
\ No newline at end of file
+    if os.getenv("ENV") == "dev":
+        # 开发模式：单进程热重载
+        uvicorn.run(
+            "main:app",
+            host="0.0.0.0",
+            port=8000,
+            reload=True,
+            log_level="info"
+        )
+    else:
+        # 生产模式：多进程（WebSocket事件经Redis Stream在各worker间共享）
+        uvicorn.run(
+            "main:app",
+            host="0.0.0.0",
+            port=8000,
+            workers=os.cpu_count(),
+            loop="uvloop",
+            http="httptools",
+            log_level="warning"
+        )
@@ -3,11 +3,13 @@ API数据模型 - Pydantic模型定义
 用于请求/响应数据验证和Swagger文档生成
 """
 
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, ConfigDict, Field
 from typing import List, Dict, Any, Optional, Tuple, Union
 from datetime import datetime
 from enum import Enum
 
+import numpy as np
+
 
 class PlatformType(str, Enum):
     """平台类型枚举"""
@@ -46,10 +48,11 @@ class Position(BaseModel):
     latitude: float = Field(..., description="纬度(度)", ge=-90, le=90)
     altitude: float = Field(..., description="高度(米)", ge=0, le=30000)
 
-    class Config:
-        json_schema_extra = {
+    model_config = ConfigDict(
+        json_schema_extra={
             "example": {"longitude": 116.5, "latitude": 39.9, "altitude": 5000}
         }
+    )
 
 
 class TargetData(BaseModel):
@@ -66,8 +69,8 @@ class TargetData(BaseModel):
     theater: Optional[str] = Field(None, description="战区")
     airport: Optional[str] = Field(None, description="机场")
 
-    class Config:
-        json_schema_extra = {
+    model_config = ConfigDict(
+        json_schema_extra={
             "example": {
                 "id": "F16-001",
                 "name": "F-16A",
@@ -82,21 +85,23 @@ class TargetData(BaseModel):
                 "airport": "AB01"
             }
         }
+    )
 
 
 class RuleConfig(BaseModel):
     """规则配置模型"""
     name: str = Field(..., description="规则名称")
     rule_type: str = Field(..., description="规则类型",
-                           enum=["DistanceRule", "AltitudeRule", "SpeedRule",
-                                 "HeadingRule", "AttributeRule", "PlatformTypeRule", "CustomRule"])
+                           json_schema_extra={"enum": ["DistanceRule", "AltitudeRule", "SpeedRule",
+                                                       "HeadingRule", "AttributeRule", "PlatformTypeRule",
+                                                       "CustomRule"]})
     priority: RulePriority = Field(default=RulePriority.MEDIUM, description="优先级")
     enabled: bool = Field(default=True, description="是否启用")
     weight: float = Field(default=1.0, description="权重", ge=0, le=2)
     params: Dict[str, Any] = Field(default_factory=dict, description="规则参数")
 
-    class Config:
-        json_schema_extra = {
+    model_config = ConfigDict(
+        json_schema_extra={
             "example": {
                 "name": "CustomDistance",
                 "rule_type": "DistanceRule",
@@ -109,6 +114,7 @@ class RuleConfig(BaseModel):
                 }
             }
         }
+    )
 
 
 class RulePreset(BaseModel):
@@ -125,15 +131,67 @@ class TimeRange(BaseModel):
     end: Optional[datetime] = Field(None, description="结束时间")
 
 
+def to_soa(targets: List[Any]) -> Dict[str, np.ndarray]:
+    """
+    目标列表转换为列式结构（Struct-of-Arrays）
+
+    数值字段为连续float64数组，其余字段为object数组；
+    兼容 TargetData 及 api_models_fast.TargetData
+
+    Returns:
+        {"id", "name", "type", "time", "lon", "lat", "alt", "heading", "speed",
+         "nation", "alliance", "theater", "airport"}
+    """
+    n = len(targets)
+
+    def objects(getter):
+        arr = np.empty(n, dtype=object)
+        arr[:] = [getter(t) for t in targets]
+        return arr
+
+    def floats(getter):
+        return np.fromiter((getter(t) for t in targets), dtype=np.float64, count=n)
+
+    return {
+        "id": objects(lambda t: t.id),
+        "name": objects(lambda t: t.name),
+        "type": objects(lambda t: t.type.value if isinstance(t.type, Enum) else t.type),
+        "time": objects(lambda t: t.time),
+        "lon": floats(lambda t: t.position.longitude),
+        "lat": floats(lambda t: t.position.latitude),
+        "alt": floats(lambda t: t.position.altitude),
+        "heading": floats(lambda t: t.heading),
+        "speed": floats(lambda t: t.speed),
+        "nation": objects(lambda t: t.nation),
+        "alliance": objects(lambda t: t.alliance),
+        "theater": objects(lambda t: t.theater),
+        "airport": objects(lambda t: t.airport),
+    }
+
+
+def to_epoch_range(time_range: Optional[Any]) -> Optional[Tuple[Optional[int], Optional[int]]]:
+    """
+    时间范围转换为epoch秒元组（兼容 TimeRange 及 api_models_fast.TimeRange）
+
+    naive时间按本地时间解释
+    """
+    if time_range is None:
+        return None
+    return (
+        int(time_range.start.timestamp()) if time_range.start else None,
+        int(time_range.end.timestamp()) if time_range.end else None
+    )
+
+
 class RecognitionRequest(BaseModel):
     """识别请求模型"""
-    targets: List[TargetData] = Field(..., description="目标数据列表", min_items=2)
+    targets: List[TargetData] = Field(..., description="目标数据列表", min_length=2)
     preset: Optional[str] = Field("tight_fighter", description="规则预设名称")
     scene_type: Optional[SceneType] = Field(None, description="场景类型（用于自适应）")
     time_range: Optional[TimeRange] = Field(None, description="分析时间范围")
 
-    class Config:
-        json_schema_extra = {
+    model_config = ConfigDict(
+        json_schema_extra={
             "example": {
                 "targets": [
                     {
@@ -163,6 +221,7 @@ class RecognitionRequest(BaseModel):
                 "scene_type": "air_superiority"
             }
         }
+    )
 
 
 class FormationMemberInfo(BaseModel):
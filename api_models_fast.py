@@ -0,0 +1,62 @@
+"""
+API数据模型（快速解码版）- msgspec Struct定义
+用于热点接口的请求体解码，字段与约束与 api_models 中的Pydantic模型保持一致；
+Swagger文档仍由 api_models 生成
+"""
+
+from datetime import datetime
+from typing import Annotated, Any, List, Optional
+
+import msgspec
+
+from api_models import PlatformType, SceneType
+
+
+class Position(msgspec.Struct, frozen=True, gc=False):
+    """位置模型"""
+    longitude: Annotated[float, msgspec.Meta(ge=-180, le=180)]
+    latitude: Annotated[float, msgspec.Meta(ge=-90, le=90)]
+    altitude: Annotated[float, msgspec.Meta(ge=0, le=30000)]
+
+
+class TargetData(msgspec.Struct, frozen=True, gc=False):
+    """目标数据模型"""
+    id: Annotated[str, msgspec.Meta(min_length=1, max_length=50)]
+    time: datetime
+    position: Position
+    name: Optional[str] = None
+    type: PlatformType = PlatformType.UNKNOWN
+    heading: Annotated[float, msgspec.Meta(ge=0, le=360)] = 0.0
+    speed: Annotated[float, msgspec.Meta(ge=0, le=1000)] = 0.0
+    nation: Optional[str] = None
+    alliance: Optional[str] = None
+    theater: Optional[str] = None
+    airport: Optional[str] = None
+
+
+class TimeRange(msgspec.Struct, frozen=True, gc=False):
+    """时间范围模型"""
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+
+
+class RecognitionRequest(msgspec.Struct, frozen=True):
+    """识别请求模型"""
+    targets: Annotated[List[TargetData], msgspec.Meta(min_length=2)]
+    preset: Optional[str] = "tight_fighter"
+    scene_type: Optional[SceneType] = None
+    time_range: Optional[TimeRange] = None
+
+
+# 解码器复用（strict=False 与Pydantic宽松模式一致，允许时间戳等类型转换）
+_recognition_decoder = msgspec.json.Decoder(RecognitionRequest, strict=False)
+
+
+def decode_recognition_request(body: bytes) -> RecognitionRequest:
+    """解码识别请求（校验失败抛出 msgspec.ValidationError）"""
+    return _recognition_decoder.decode(body)
+
+
+def to_builtins(obj: Any) -> Any:
+    """转换为内置类型（保留datetime对象，供业务层使用）"""
+    return msgspec.to_builtins(obj, builtin_types=(datetime,))
@@ -0,0 +1,77 @@
+"""
+API请求体解析 - msgspec/orjson直接解码请求体（FastAPI依赖）
+main.py 与 api_cache.py 的识别接口共用，文档仍由 api_models 中的Pydantic模型生成
+"""
+
+import asyncio
+from typing import Any, Dict, List
+
+import msgspec
+import orjson
+from fastapi import Request
+from fastapi.exceptions import RequestValidationError
+
+import api_models_fast
+from api_models import RecognitionRequest
+
+# 超过该大小的请求体在线程池中解析校验，避免阻塞事件循环
+_LARGE_BODY_THRESHOLD = 256 * 1024
+
+
+async def _load_body(request: Request, loader):
+    """读取并解析请求体（超大请求体放到线程池中解析）"""
+    raw = await request.body()
+    if len(raw) > _LARGE_BODY_THRESHOLD:
+        return await asyncio.to_thread(loader, raw)
+    return loader(raw)
+
+
+async def parse_recognition_request(request: Request) -> api_models_fast.RecognitionRequest:
+    """解析识别请求（msgspec直接解码为Struct，文档仍使用Pydantic模型）"""
+    try:
+        return await _load_body(request, api_models_fast.decode_recognition_request)
+    except (msgspec.ValidationError, msgspec.DecodeError) as e:
+        raise RequestValidationError(
+            [{"type": "value_error", "loc": ("body",), "msg": str(e)}]
+        )
+
+
+async def parse_target_list(request: Request) -> List[Dict]:
+    """解析目标数据列表"""
+    try:
+        targets = await _load_body(request, orjson.loads)
+    except orjson.JSONDecodeError as e:
+        raise RequestValidationError(
+            [{"type": "json_invalid", "loc": ("body", e.pos), "msg": f"JSON解析失败: {e.msg}"}]
+        )
+
+    if not isinstance(targets, list):
+        raise RequestValidationError(
+            [{"type": "list_type", "loc": ("body",), "msg": "请求体应为目标数据列表"}]
+        )
+    return targets
+
+
+def _openapi_body(schema: Dict[str, Any]) -> Dict[str, Any]:
+    """手动解析请求体的接口仍在文档中展示请求体结构（内联$defs引用）"""
+    defs = schema.pop("$defs", {})
+
+    def resolve(node):
+        if isinstance(node, dict):
+            if "$ref" in node:
+                return resolve(defs[node["$ref"].split("/")[-1]])
+            return {k: resolve(v) for k, v in node.items()}
+        if isinstance(node, list):
+            return [resolve(v) for v in node]
+        return node
+
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": resolve(schema)}}
+        }
+    }
+
+
+RECOGNITION_OPENAPI = _openapi_body(RecognitionRequest.model_json_schema())
+TARGET_LIST_OPENAPI = _openapi_body({"type": "array", "items": {"type": "object"}})
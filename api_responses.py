@@ -0,0 +1,24 @@
+"""
+API响应类 - 基于orjson的JSON响应
+"""
+
+from typing import Any
+
+import orjson
+from fastapi.responses import ORJSONResponse
+
+# 响应编码选项：允许非字符串键，numpy数组/标量直接编码
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+class FastORJSONResponse(ORJSONResponse):
+    """
+    orjson响应
+
+    datetime、numpy 类型在C层直接编码，处理函数中无需手动 isoformat()/tolist()；
+    直接返回该响应时同时跳过 jsonable_encoder 的逐项遍历
+    """
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, option=ORJSON_OPTIONS)
@@ -1,13 +1,19 @@
 """
 缓存相关API接口 - 增量同步、编队查询、纯缓存操作
 """
+import asyncio
 import logging
-from typing import List, Optional
+import time
+from typing import List, Dict, Optional, Any, Iterator
 from datetime import datetime, timedelta
 
+import orjson
+
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query, HTTPException, Body
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 
+from api_responses import FastORJSONResponse
+from cache.redis_client import redis_client
 from cache.target_cache import target_cache
 from cache.formation_store import formation_store
 from sync.delta_sync import delta_sync
@@ -16,7 +22,14 @@ from formation_service import formation_service  # 导入服务实例
 
 logger = logging.getLogger(__name__)
 
-router = APIRouter(prefix="/cache", tags=["缓存与同步"])
+router = APIRouter(prefix="/cache", tags=["缓存与同步"], default_response_class=FastORJSONResponse)
+
+
+def _time_range(start: datetime, end: datetime, as_epoch: bool = False) -> Dict:
+    """构建响应中的时间范围（datetime交由orjson在C层编码，或返回epoch秒）"""
+    if as_epoch:
+        return {"start": int(start.timestamp()), "end": int(end.timestamp())}
+    return {"start": start, "end": end}
 
 
 # ==================== 纯缓存操作接口（不触发识别） ====================
@@ -31,39 +44,20 @@ async def batch_update_targets(
 
     用于外部系统同步数据到缓存，供后续增量查询或识别使用
     """
-    # 临时关闭事件发送，手动控制
-    result = formation_service.cache_targets_only(targets)
-
-    # 手动发送WebSocket事件
-    if emit_events:
-        for update in result.get("details", {}).get("updated", []):
-            if update.get("has_delta"):
-                tid = update["target_id"]
-                # 获取增量事件发送
-                try:
-                    import asyncio
-                    events = target_cache.get_delta_since(tid, update["version"] - 1)
-                    if events:
-                        asyncio.create_task(
-                            websocket_manager.notify_target_update(tid, events[-1])
-                        )
-                except Exception as e:
-                    logger.warning(f"发送事件失败: {e}")
+    # 增量事件随写入结果整批推送（不再逐个目标回读增量流）
+    result = await formation_service.acache_targets_only(targets, emit_events=emit_events)
 
     return result
 
 
 @router.get("/targets/{target_id}/delta")
-async def get_target_delta(
+def get_target_delta(
         target_id: str,
         since_version: int = Query(..., description="起始版本号"),
         limit: int = Query(100, ge=1, le=1000)
 ):
     """获取单个目标的增量历史"""
-    events = target_cache.get_delta_since(target_id, since_version)
-
-    # 限制数量
-    events = events[:limit]
+    events = target_cache.get_delta_since(target_id, since_version, limit=limit)
 
     return {
         "success": True,
@@ -75,30 +69,28 @@ async def get_target_delta(
 
 
 @router.get("/targets/{target_id}/history")
-async def get_target_history(
+def get_target_history(
         target_id: str,
         start: datetime = Query(..., description="开始时间"),
-        end: datetime = Query(..., description="结束时间")
+        end: datetime = Query(..., description="结束时间"),
+        as_epoch: bool = Query(False, description="time_range以epoch秒返回")
 ):
     """获取目标在指定时间范围内的历史增量"""
     events = target_cache.get_delta_in_range(target_id, start, end)
 
-    return {
+    return FastORJSONResponse({
         "success": True,
         "target_id": target_id,
-        "time_range": {
-            "start": start.isoformat(),
-            "end": end.isoformat()
-        },
+        "time_range": _time_range(start, end, as_epoch),
         "events_count": len(events),
         "events": events
-    }
+    })
 
 
 # ==================== 增量同步接口 ====================
 
 @router.post("/sync/session")
-async def create_sync_session(
+def create_sync_session(
         client_id: str = Body(..., description="客户端唯一标识"),
         target_ids: Optional[List[str]] = Body(None, description="关注的目标列表（空表示全部）")
 ):
@@ -114,7 +106,7 @@ async def create_sync_session(
 
 
 @router.post("/sync/pull")
-async def pull_delta(
+def pull_delta(
         session_id: Optional[str] = Body(None, description="同步会话ID"),
         since_versions: Optional[dict] = Body(None, description="各目标版本号"),
         target_ids: Optional[List[str]] = Body(None, description="目标列表")
@@ -134,16 +126,39 @@ async def pull_delta(
     if "error" in result:
         raise HTTPException(status_code=500, detail=result["error"])
 
-    return {
-        "success": True,
-        "is_full_sync": result.get("full_sync", False),
-        "updated_targets": result.get("metadata", {}).get("updated_targets", 0),
-        "data": result
-    }
+    return StreamingResponse(_stream_delta(result), media_type="application/json")
+
+
+def _stream_delta(result: Dict[str, Any]) -> Iterator[bytes]:
+    """
+    分段编码增量数据包
+
+    输出与 {"success", "is_full_sync", "updated_targets", "data": result} 一致的JSON，
+    targets 逐个目标编码输出，避免一次性生成完整响应体
+    """
+    targets = result.get("targets", {})
+    head = {k: v for k, v in result.items() if k != "targets"}
+
+    yield (b'{"success":true,"is_full_sync":'
+           + orjson.dumps(result.get("full_sync", False))
+           + b',"updated_targets":'
+           + orjson.dumps(result.get("metadata", {}).get("updated_targets", 0))
+           + b',"data":'
+           + orjson.dumps(head, option=orjson.OPT_NON_STR_KEYS)[:-1])
+
+    # head 可能为空对象，此时 targets 前不加逗号
+    yield b',"targets":{' if head else b'"targets":{'
+
+    for i, (tid, item) in enumerate(targets.items()):
+        yield ((b"," if i else b"")
+               + orjson.dumps(tid) + b":"
+               + orjson.dumps(item, option=orjson.OPT_NON_STR_KEYS))
+
+    yield b"}}}"
 
 
 @router.post("/sync/compare")
-async def compare_and_sync(client_states: dict = Body(...)):
+def compare_and_sync(client_states: dict = Body(...)):
     """
     对比同步 - 客户端上传本地状态，服务器返回差异
 
@@ -162,15 +177,35 @@ async def compare_and_sync(client_states: dict = Body(...)):
 
 # ==================== WebSocket实时推送 ====================
 
+# PONG时间戳缓存 [整秒, ISO字符串]：同一秒内的心跳复用同一字符串
+_pong_ts = [0, ""]
+
+
+def _pong_timestamp() -> str:
+    """获取PONG时间戳（秒级精度，每秒最多格式化一次）"""
+    now = int(time.time())
+    if now != _pong_ts[0]:
+        _pong_ts[0] = now
+        _pong_ts[1] = datetime.fromtimestamp(now).isoformat()
+    return _pong_ts[1]
+
+
 @router.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
-    """WebSocket实时数据推送"""
+    """
+    WebSocket实时数据推送
+
+    SUBSCRIBE 消息可携带 since_versions（{target_id: version}），
+    此时返回 INITIAL_DELTA（仅版本之后的变化），否则返回 INITIAL_STATE 全量
+
+    支持JSON文本帧与msgpack二进制帧：客户端发送msgpack消息后，服务端推送也改用msgpack
+    """
     await websocket_manager.connect(websocket, client_id)
 
     try:
         while True:
-            # 接收客户端消息
-            data = await websocket.receive_json()
+            # 接收客户端消息（JSON文本帧或msgpack二进制帧）
+            data = await websocket_manager.receive(client_id)
 
             msg_type = data.get("type")
 
@@ -179,13 +214,25 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
                 target_ids = data.get("target_ids", [])
                 await websocket_manager.subscribe_targets(client_id, target_ids)
 
-                # 立即发送当前状态（全量）
+                # 立即发送当前状态：客户端带版本号时只发送增量，否则发送全量
                 if target_ids:
-                    full_state = delta_sync.pull_full_state(target_ids)
-                    await websocket_manager.send_personal_message(client_id, {
-                        "type": "INITIAL_STATE",
-                        "data": full_state
-                    })
+                    since_versions = data.get("since_versions")
+                    if since_versions:
+                        delta = await asyncio.to_thread(
+                            delta_sync.pull_delta,
+                            target_ids=target_ids,
+                            since_versions=since_versions
+                        )
+                        await websocket_manager.send_personal_message(client_id, {
+                            "type": "INITIAL_DELTA",
+                            "data": delta
+                        })
+                    else:
+                        full_state = await asyncio.to_thread(delta_sync.pull_full_state, target_ids)
+                        await websocket_manager.send_personal_message(client_id, {
+                            "type": "INITIAL_STATE",
+                            "data": full_state
+                        })
 
             elif msg_type == "UNSUBSCRIBE":
                 # 取消订阅
@@ -196,7 +243,7 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
                 # 心跳响应
                 await websocket_manager.send_personal_message(client_id, {
                     "type": "PONG",
-                    "timestamp": datetime.now().isoformat()
+                    "timestamp": _pong_timestamp()
                 })
 
             elif msg_type == "GET_DELTA":
@@ -224,16 +271,12 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
 # ==================== 编队结果查询接口 ====================
 
 @router.get("/formations/recent")
-async def get_recent_formations(
+def get_recent_formations(
         count: int = Query(10, ge=1, le=100, description="返回数量"),
         include_tracks: bool = Query(False, description="是否包含完整航迹")
 ):
     """获取最近的编队识别结果"""
-    formations = formation_store.get_latest_formations(count)
-
-    if not include_tracks:
-        for f in formations:
-            f.pop("full_tracks", None)
+    formations = formation_store.get_latest_formations(count, include_tracks=include_tracks)
 
     return {
         "success": True,
@@ -243,33 +286,34 @@ async def get_recent_formations(
 
 
 @router.get("/formations/range")
-async def get_formations_by_time_range(
+def get_formations_by_time_range(
         start: datetime = Query(..., description="开始时间 (ISO格式)"),
         end: datetime = Query(..., description="结束时间 (ISO格式)"),
-        limit: int = Query(100, ge=1, le=1000)
+        limit: int = Query(100, ge=1, le=1000),
+        as_epoch: bool = Query(False, description="time_range以epoch秒返回")
 ):
     """按时间范围查询编队"""
     formations = formation_store.get_formations_by_time_range(start, end, limit)
 
-    return {
+    return FastORJSONResponse({
         "success": True,
         "count": len(formations),
-        "time_range": {
-            "start": start.isoformat(),
-            "end": end.isoformat()
-        },
+        "time_range": _time_range(start, end, as_epoch),
         "formations": formations
-    }
+    })
 
 
 @router.get("/formations/date/{date_str}")
-async def get_formations_by_date(
+def get_formations_by_date(
         date_str: str,
         limit: int = Query(1000, ge=1, le=5000)
 ):
     """按日期查询编队（格式: YYYYMMDD）"""
+    # 固定8位数字格式，直接切片解析（比strptime快）
+    if len(date_str) != 8 or not date_str.isdigit():
+        raise HTTPException(status_code=400, detail="日期格式错误，应为YYYYMMDD")
     try:
-        date = datetime.strptime(date_str, "%Y%m%d")
+        date = datetime(int(date_str[0:4]), int(date_str[4:6]), int(date_str[6:8]))
     except ValueError:
         raise HTTPException(status_code=400, detail="日期格式错误，应为YYYYMMDD")
 
@@ -284,7 +328,7 @@ async def get_formations_by_date(
 
 
 @router.get("/formations/{formation_id}")
-async def get_formation_detail(formation_id: str):
+def get_formation_detail(formation_id: str):
     """获取编队详情"""
     formation = formation_store.get_formation(formation_id)
 
@@ -298,7 +342,7 @@ async def get_formation_detail(formation_id: str):
 
 
 @router.get("/formations/statistics/overview")
-async def get_formation_statistics(
+def get_formation_statistics(
         days: int = Query(7, ge=1, le=30, description="统计天数")
 ):
     """获取编队统计信息"""
@@ -313,7 +357,7 @@ async def get_formation_statistics(
 # ==================== 目标状态查询接口 ====================
 
 @router.get("/targets/active")
-async def get_active_targets():
+def get_active_targets():
     """获取所有活跃目标"""
     target_ids = target_cache.get_all_active_targets()
 
@@ -324,41 +368,65 @@ async def get_active_targets():
     }
 
 
+# 紧凑格式的列顺序
+_STATE_COLUMNS = ("target_id", "longitude", "latitude", "altitude", "heading", "speed", "timestamp")
+
+
 @router.post("/targets/batch_query")
-async def batch_query_targets(target_ids: List[str] = Body(...)):
-    """批量查询目标当前状态"""
+def batch_query_targets(
+        target_ids: List[str] = Body(...),
+        compact: bool = Query(False, description="紧凑格式（按行返回数组，时间为epoch秒）")
+):
+    """
+    批量查询目标当前状态
+
+    - 默认: states 为 {target_id: {position, heading, speed, timestamp}}
+    - compact=true: states 为按 columns 顺序排列的数组列表，适合大批量查询
+    """
     states = target_cache.get_targets_batch(target_ids)
 
-    result = {}
-    for tid, state in states.items():
-        result[tid] = {
-            "position": {
-                "longitude": state.position.longitude,
-                "latitude": state.position.latitude,
-                "altitude": state.position.altitude
-            },
-            "heading": state.heading,
-            "speed": state.speed,
-            "timestamp": state.timestamp.isoformat()
+    if compact:
+        rows = [
+            (tid, state.position.longitude, state.position.latitude, state.position.altitude,
+             state.heading, state.speed, state.timestamp.timestamp())
+            for tid, state in states.items()
+        ]
+        body = {"columns": _STATE_COLUMNS, "states": rows}
+    else:
+        body = {
+            "states": {
+                tid: {
+                    "position": {
+                        "longitude": state.position.longitude,
+                        "latitude": state.position.latitude,
+                        "altitude": state.position.altitude
+                    },
+                    "heading": state.heading,
+                    "speed": state.speed,
+                    "timestamp": state.timestamp
+                }
+                for tid, state in states.items()
+            }
         }
 
-    return {
+    # 直接返回响应，跳过jsonable_encoder对整个结果的逐项遍历
+    return FastORJSONResponse({
         "success": True,
-        "found": len(result),
-        "not_found": list(set(target_ids) - set(result.keys())),
-        "states": result
-    }
+        "found": len(states),
+        "not_found": [tid for tid in target_ids if tid not in states],
+        **body
+    })
 
 
 @router.get("/targets/{target_id}/state")
-async def get_target_state(target_id: str):
+def get_target_state(target_id: str):
     """获取目标当前状态"""
     state = target_cache.get_target_state(target_id)
 
     if not state:
         raise HTTPException(status_code=404, detail="目标不存在或已过期")
 
-    return {
+    return FastORJSONResponse({
         "success": True,
         "target_id": target_id,
         "state": {
@@ -369,16 +437,16 @@ async def get_target_state(target_id: str):
             },
             "heading": state.heading,
             "speed": state.speed,
-            "timestamp": state.timestamp.isoformat()
+            "timestamp": state.timestamp
         },
         "version": target_cache.get_target_version(target_id)
-    }
+    })
 
 
 # ==================== 管理接口 ====================
 
 @router.post("/admin/cleanup")
-async def trigger_cleanup():
+def trigger_cleanup():
     """手动触发数据清理"""
     stats = formation_store.cleanup_expired_data()
 
@@ -389,22 +457,34 @@ async def trigger_cleanup():
     }
 
 
+# 管理状态缓存（监控轮询时，TTL内复用同一结果）
+_ADMIN_STATUS_TTL = 1.0
+_admin_status_cache = {"ts": 0.0, "payload": None}
+
+
 @router.get("/admin/status")
 async def get_admin_status():
     """获取缓存管理状态"""
-    return {
-        "success": True,
-        "redis": {
-            "connected": formation_service.get_cache_status().get("redis_connected", False),
-            "active_targets": len(target_cache.get_all_active_targets())
-        },
-        "service": formation_service.get_statistics(),
-        "cache_stats": formation_service.cache_stats
-    }
+    now = time.monotonic()
+    if _admin_status_cache["payload"] is None or now - _admin_status_cache["ts"] > _ADMIN_STATUS_TTL:
+        # get_cache_status 已读取活跃目标列表，直接复用其计数
+        cache_status = await asyncio.to_thread(formation_service.get_cache_status)
+        _admin_status_cache["payload"] = {
+            "success": True,
+            "redis": {
+                "connected": cache_status.get("redis_connected", False),
+                "active_targets": cache_status.get("active_targets_in_cache", 0)
+            },
+            "service": formation_service.get_statistics(),
+            "cache_stats": formation_service.cache_stats
+        }
+        _admin_status_cache["ts"] = now
+
+    return _admin_status_cache["payload"]
 
 
 @router.post("/admin/clear")
-async def clear_cache(
+def clear_cache(
         target_ids: Optional[List[str]] = Body(None, description="指定目标（空表示全部）")
 ):
     """清理缓存"""
@@ -413,15 +493,13 @@ async def clear_cache(
 
 
 @router.get("/health")
-async def cache_health():
+def cache_health():
     """缓存健康检查"""
-    from cache.redis_client import redis_client
-
     redis_ok = redis_client.ping()
 
-    return {
+    return FastORJSONResponse({
         "success": True,
         "redis_connected": redis_ok,
-        "active_targets": len(target_cache.get_all_active_targets()),
-        "timestamp": datetime.now().isoformat()
-    }
\ No newline at end of file
+        "active_targets": target_cache.count_active_targets(),
+        "timestamp": datetime.now()
+    })
\ No newline at end of file
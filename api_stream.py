@@ -1,20 +1,57 @@
 """
 数据流 API - 持续数据输入和结果查询
 """
+import asyncio
 import logging
 from typing import List, Dict, Any, Optional
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query, Body, HTTPException
 from fastapi.responses import JSONResponse
+import orjson
 
+from api_responses import FastORJSONResponse, ORJSON_OPTIONS
 from stream_service import stream_service
 from cache.formation_store import formation_store
 from sync.websocket_manager import websocket_manager
 
 logger = logging.getLogger(__name__)
 
-router = APIRouter(prefix="/stream", tags=["数据流"])
+router = APIRouter(prefix="/stream", tags=["数据流"], default_response_class=FastORJSONResponse)
+
+
+# 单帧最多合并的ACK数量
+_ACK_BATCH_SIZE = 64
+
+
+async def _send_json(websocket: WebSocket, message: dict):
+    """以orjson编码发送JSON文本帧（替代 send_json 的标准库json编码）"""
+    await websocket.send_text(orjson.dumps(message, option=ORJSON_OPTIONS).decode())
+
+
+async def _receive_json(websocket: WebSocket) -> Any:
+    """接收JSON消息（文本帧或二进制帧均用orjson解析）"""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    return orjson.loads(message.get("text") or message.get("bytes") or b"")
+
+
+async def _drain_acks(websocket: WebSocket, queue: asyncio.Queue):
+    """
+    ACK发送任务
+
+    积压时将多个ACK合并为一帧 ACK_BATCH 发送，无积压时保持单条 ACK 格式
+    """
+    while True:
+        batch = [await queue.get()]
+        while not queue.empty() and len(batch) < _ACK_BATCH_SIZE:
+            batch.append(queue.get_nowait())
+
+        if len(batch) == 1:
+            await _send_json(websocket, batch[0])
+        else:
+            await _send_json(websocket, {"type": "ACK_BATCH", "items": batch})
 
 
 # ==================== 数据输入接口 ====================
@@ -57,9 +94,17 @@ async def websocket_push(websocket: WebSocket, source: str = "ws"):
     await websocket.accept()
     client_id = f"stream_{id(websocket)}"
 
+    # ACK进入队列由发送任务异步发出，接收循环不等待发送完成
+    ack_queue: asyncio.Queue = asyncio.Queue()
+    drain_task = asyncio.create_task(_drain_acks(websocket, ack_queue))
+
     try:
         while True:
-            data = await websocket.receive_json()
+            if drain_task.done():
+                # 发送任务异常退出（连接已不可写）
+                raise drain_task.exception() or WebSocketDisconnect()
+
+            data = await _receive_json(websocket)
 
             # 支持两种格式：单条或批量
             if isinstance(data, list):
@@ -73,7 +118,7 @@ async def websocket_push(websocket: WebSocket, source: str = "ws"):
             result = await stream_service.push_data(targets, source)
 
             # 返回确认
-            await websocket.send_json({
+            ack_queue.put_nowait({
                 "type": "ACK",
                 "received": len(targets),
                 "status": result
@@ -84,6 +129,8 @@ async def websocket_push(websocket: WebSocket, source: str = "ws"):
     except Exception as e:
         logger.error(f"数据流 WebSocket 错误 [{client_id}]: {e}")
         await websocket.close()
+    finally:
+        drain_task.cancel()
 
 
 # ==================== 结果查询接口 ====================
@@ -96,11 +143,11 @@ async def get_latest_stream_formations(
     """
     获取最近识别的编队（数据流自动识别的结果）
     """
-    formations = stream_service.get_recent_formations(count)
-
-    if not include_tracks:
-        for f in formations:
-            f.pop("full_tracks", None)
+    # Redis读取放到线程池执行，避免阻塞事件循环
+    # include_tracks=False 时只读摘要key，航迹不经网络传输
+    formations = await asyncio.to_thread(
+        stream_service.get_recent_formations, count, include_tracks
+    )
 
     return {
         "success": True,
@@ -113,18 +160,21 @@ async def get_latest_stream_formations(
 @router.get("/formations/since")
 async def get_formations_since(
         since: datetime = Query(..., description="查询此时间之后的编队"),
-        limit: int = Query(100, ge=1, le=1000)
+        limit: int = Query(100, ge=1, le=1000),
+        newest_first: bool = Query(False, description="按时间从新到旧返回（取最新的limit条）")
 ):
     """获取指定时间之后识别的编队"""
-    formations = formation_store.get_formations_by_time_range(
+    formations = await asyncio.to_thread(
+        formation_store.get_formations_by_time_range,
         start=since,
         end=datetime.now(),
-        limit=limit
+        limit=limit,
+        desc=newest_first
     )
 
     return {
         "success": True,
-        "since": since.isoformat(),
+        "since": since,
         "count": len(formations),
         "formations": formations
     }
@@ -138,20 +188,17 @@ async def get_active_formations():
     基于最近识别的编队，结合缓存中的目标状态判断
     """
     # 获取最近 1 小时的编队
-    from datetime import timedelta
-    since = datetime.now() - timedelta(hours=1)
+    now = datetime.now()
+    recent = await asyncio.to_thread(
+        formation_store.get_formations_by_time_range, now - timedelta(hours=1), now, limit=100
+    )
 
-    recent = formation_store.get_formations_by_time_range(since, datetime.now(), limit=100)
+    # 过滤：检查编队成员是否仍在缓存中（Redis端集合交集计数）
+    live_counts = await asyncio.to_thread(formation_store.get_live_member_counts, recent)
 
-    # 过滤：检查编队成员是否仍在缓存中
     active_formations = []
-    for formation in recent:
+    for formation, active_members in zip(recent, live_counts):
         members = formation.get("members", {})
-        active_members = 0
-
-        for tid in members.keys():
-            if target_cache.get_target_state(tid):
-                active_members += 1
 
         # 超过 50% 成员活跃则认为编队活跃
         if len(members) > 0 and active_members / len(members) >= 0.5:
@@ -246,8 +293,8 @@ async def websocket_results(websocket: WebSocket):
 
     try:
         # 发送历史最近 5 个编队作为初始数据
-        recent = stream_service.get_recent_formations(5)
-        await websocket.send_json({
+        recent = await asyncio.to_thread(stream_service.get_recent_formations, 5)
+        await _send_json(websocket, {
             "type": "INITIAL",
             "recent_formations": recent
         })
@@ -255,17 +302,17 @@ async def websocket_results(websocket: WebSocket):
         # 保持连接，等待推送
         while True:
             # 接收心跳或控制命令
-            data = await websocket.receive_json()
+            data = await _receive_json(websocket)
 
             if data.get("type") == "PING":
-                await websocket.send_json({
+                await _send_json(websocket, {
                     "type": "PONG",
                     "timestamp": datetime.now().isoformat()
                 })
             elif data.get("type") == "GET_LATEST":
                 count = data.get("count", 10)
-                formations = stream_service.get_recent_formations(count)
-                await websocket.send_json({
+                formations = await asyncio.to_thread(stream_service.get_recent_formations, count)
+                await _send_json(websocket, {
                     "type": "LATEST_RESPONSE",
                     "formations": formations
                 })
@@ -1,17 +1,28 @@
 """
 编队识别结果存储 - 7天滚动存储，支持时间序列查询
 """
+import itertools
 import json
 import logging
+import os
+import time
 from typing import Dict, List, Optional, Any, Tuple
 from datetime import datetime, timedelta
 from dataclasses import asdict
 
 from cache.redis_client import redis_client, RedisConfig
+from cache.target_cache import target_cache
 from models import Formation
 
 logger = logging.getLogger(__name__)
 
+# 旧版Hash存储中除完整航迹外的摘要字段（与 Formation.to_dict 及存储元数据保持一致）
+FORMATION_SUMMARY_FIELDS = (
+    "formation_id", "formation_type", "confidence", "status", "time", "members",
+    "spatial", "motion", "coordination", "rules_applied", "rule_confidences",
+    "_stored_at", "_expires_at",
+)
+
 
 class FormationStore:
     """编队结果存储管理器"""
@@ -19,11 +30,26 @@ class FormationStore:
     def __init__(self):
         self.redis = redis_client
         self.RETENTION_DAYS = 7
+        self._orphan_script_obj = None
+        # 编队ID序号：进程内递增计数，高16位异或进程号，多worker同毫秒也不冲突
+        self._id_counter = itertools.count()
+        self._id_salt = (os.getpid() & 0xffff) << 16
+        self._store_script_obj = None
+        self._time_range_script_obj = None
+        self._decrement_stats_script_obj = None
 
     def _make_formation_key(self, formation_id: str) -> str:
-        """构建编队数据key"""
+        """构建编队数据key（摘要，不含完整航迹）"""
         return self.redis._make_key("formation", formation_id)
 
+    def _make_tracks_key(self, formation_id: str) -> str:
+        """构建编队完整航迹key"""
+        return self.redis._make_key("formation", formation_id, "tracks")
+
+    def _make_members_key(self, formation_id: str) -> str:
+        """构建编队成员ID集合key"""
+        return self.redis._make_key("formation", formation_id, "members")
+
     def _make_timeline_key(self) -> str:
         """构建时间线索引key"""
         return self.redis._make_key("formations", "timeline")
@@ -32,19 +58,24 @@ class FormationStore:
         """构建日索引key"""
         return self.redis._make_key("formations", "daily", date_str)
 
+    def _make_daily_stats_key(self, date_str: str) -> str:
+        """构建日统计key（Hash：count / confidence_sum / type:<编队类型>）"""
+        return self.redis._make_key("formations", "stats", date_str)
+
     def _formation_to_dict(self, formation: Formation) -> Dict[str, Any]:
         """编队对象转换为字典"""
         # 使用Formation自带的to_dict方法，并添加元数据
         data = formation.to_dict(include_full_track=True)
-        data["_stored_at"] = datetime.now().isoformat()
-        data["_expires_at"] = (datetime.now() + timedelta(days=self.RETENTION_DAYS)).isoformat()
+        now = datetime.now()
+        data["_stored_at"] = now.isoformat()
+        data["_expires_at"] = (now + timedelta(days=self.RETENTION_DAYS)).isoformat()
         return data
 
     def _generate_formation_id(self, timestamp: datetime) -> str:
         """生成编队ID"""
         ts = int(timestamp.timestamp() * 1000)
-        import uuid
-        return f"F{ts}_{uuid.uuid4().hex[:8]}"
+        seq = (next(self._id_counter) ^ self._id_salt) & 0xffffffff
+        return f"F{ts}_{seq:08x}"
 
     # ==================== 核心存储操作 ====================
 
@@ -56,67 +87,88 @@ class FormationStore:
         Returns:
             存储的编队ID
         """
-        try:
-            # 生成或使用自定义ID
-            formation_id = custom_id or self._generate_formation_id(formation.create_time)
-
-            # 转换数据
-            data = self._formation_to_dict(formation)
-            data["formation_id"] = formation_id  # 确保ID一致
-
-            # 存储编队详情（Hash）
-            formation_key = self._make_formation_key(formation_id)
-
-            pipe = self.redis.pipeline()
-
-            # 使用Hash存储，便于字段查询
-            for field, value in data.items():
-                serialized = self.redis._serialize(value)
-                pipe.hset(formation_key, field, serialized)
+        ids = self._store_formations([(formation, custom_id)])
+        return ids[0] if ids else None
 
-            # 设置7天过期
-            pipe.expire(formation_key, RedisConfig.FORMATION_TTL)
+    def store_formations_batch(self, formations: List[Formation]) -> List[str]:
+        """批量存储编队结果（整批一个管道，一次往返）"""
+        return self._store_formations([(formation, None) for formation in formations])
 
-            # 添加到时间线索引（Sorted Set，按创建时间排序）
-            timeline_key = self._make_timeline_key()
-            score = formation.create_time.timestamp()
-            pipe.zadd(timeline_key, {formation_id: score})
+    def _store_formations(self, items: List[Tuple[Formation, Optional[str]]]) -> List[str]:
+        """
+        批量存储编队
 
-            # 添加到日索引
-            date_str = formation.create_time.strftime("%Y%m%d")
-            daily_key = self._make_daily_key(date_str)
-            pipe.zadd(daily_key, {formation_id: score})
-            # 日索引也设置7天过期
-            pipe.expire(daily_key, RedisConfig.FORMATION_TTL)
+        整批数据由一次Lua脚本调用写入（一次往返，批内原子执行）：
+        摘要/航迹/成员集合、时间线索引、日索引及日统计
 
-            pipe.execute()
+        Args:
+            items: [(编队, 自定义ID或None)]
 
-            logger.info(f"编队结果已存储 [{formation_id}]: {formation.formation_type}")
-            return formation_id
+        Returns:
+            存储成功的编队ID列表
+        """
+        try:
+            key_prefix = self._make_formation_key("")
+            args = [
+                key_prefix,
+                self._make_tracks_key("")[len(key_prefix):],
+                self._make_members_key("")[len(key_prefix):],
+                self._make_daily_key(""),
+                self._make_daily_stats_key(""),
+                RedisConfig.FORMATION_TTL,
+            ]
+            stored = []
+
+            for formation, custom_id in items:
+                try:
+                    # 生成或使用自定义ID
+                    formation_id = custom_id or self._generate_formation_id(formation.create_time)
+
+                    # 转换数据
+                    data = self._formation_to_dict(formation)
+                    data["formation_id"] = formation_id  # 确保ID一致
+
+                    # 摘要与完整航迹分别序列化存储（不需要航迹的查询只读摘要）
+                    tracks = data.pop("full_tracks", None)
+                    member_ids = list(data.get("members", {}))
+                    summary = self.redis._serialize_fast(data)
+                    tracks = self.redis._serialize_fast(tracks) if tracks is not None else b""
+                except Exception as e:
+                    logger.error(f"编队数据转换失败: {e}")
+                    continue
+
+                args.extend((
+                    formation_id,
+                    formation.create_time.timestamp(),
+                    formation.create_time.strftime("%Y%m%d"),
+                    summary,
+                    tracks,
+                    formation.formation_type,
+                    data.get("confidence", 0),
+                    len(member_ids),
+                ))
+                args.extend(member_ids)
+
+                stored.append((formation_id, formation.formation_type))
+
+            if not stored:
+                return []
+
+            self._store_script(keys=[self._make_timeline_key()], args=args)
+
+            for formation_id, formation_type in stored:
+                logger.info(f"编队结果已存储 [{formation_id}]: {formation_type}")
+            return [formation_id for formation_id, _ in stored]
 
         except Exception as e:
             logger.error(f"存储编队结果失败: {e}")
-            return None
-
-    def store_formations_batch(self, formations: List[Formation]) -> List[str]:
-        """批量存储编队结果"""
-        ids = []
-        for formation in formations:
-            fid = self.store_formation(formation)
-            if fid:
-                ids.append(fid)
-        return ids
+            return []
 
     def get_formation(self, formation_id: str) -> Optional[Dict[str, Any]]:
         """获取编队详情"""
         try:
-            key = self._make_formation_key(formation_id)
-            data = self.redis.hgetall(key)
-
-            if not data:
-                return None
-
-            return data
+            results = self._get_formations([formation_id])
+            return results[0] if results else None
         except Exception as e:
             logger.error(f"获取编队失败 [{formation_id}]: {e}")
             return None
@@ -132,24 +184,74 @@ class FormationStore:
 
             # 获取创建时间以确定日索引
             data = self.get_formation(formation_id)
-            if data and "create_time" in data:
-                create_time = datetime.fromisoformat(data["create_time"])
+            create_time = (data or {}).get("time", {}).get("create")
+            if create_time:
+                if not isinstance(create_time, datetime):
+                    create_time = datetime.fromisoformat(create_time)
                 date_str = create_time.strftime("%Y%m%d")
                 daily_key = self._make_daily_key(date_str)
-                self.redis.client.zrem(daily_key, formation_id)
+                if self.redis.client.zrem(daily_key, formation_id):
+                    self._decrement_daily_stats(date_str, data)
 
             # 删除数据
-            self.redis.delete(key)
+            self.redis.delete(key, self._make_tracks_key(formation_id),
+                              self._make_members_key(formation_id))
 
             return True
         except Exception as e:
             logger.error(f"删除编队失败 [{formation_id}]: {e}")
             return False
 
+    def _decrement_daily_stats(self, date_str: str, data: Dict[str, Any]):
+        """从日统计中扣除一条编队（统计不存在时跳过）"""
+        stats_key = self._make_daily_stats_key(date_str)
+        self._decrement_stats_script(
+            keys=[stats_key],
+            args=[data.get("confidence", 0), data.get("formation_type", "Unknown")]
+        )
+
+    def get_live_member_counts(self, formations: List[Dict[str, Any]]) -> List[int]:
+        """
+        统计各编队仍存活（状态缓存未过期）的成员数量
+
+        在Redis端对编队成员集合与存活目标索引求交集计数（ZINTERCARD），
+        每个编队一条命令、整体一次往返；无成员集合的旧数据退化为批量读取目标状态
+
+        Returns:
+            与 formations 顺序一致的存活成员数
+        """
+        live_key = target_cache.live_targets_key
+
+        pipe = self.redis.pipeline()
+        # 先移除已过期的目标
+        pipe.zremrangebyscore(live_key, "-inf", time.time())
+        for f in formations:
+            members_key = self._make_members_key(f.get("formation_id", ""))
+            pipe.exists(members_key)
+            pipe.zintercard(2, [members_key, live_key])
+        raw = pipe.execute()[1:]
+
+        counts = []
+        legacy = []
+        for i, f in enumerate(formations):
+            has_members_key, count = raw[2 * i], raw[2 * i + 1]
+            if not has_members_key and f.get("members"):
+                legacy.append(i)
+            counts.append(count)
+
+        if legacy:
+            member_ids = list({tid for i in legacy for tid in formations[i]["members"]})
+            cached = target_cache.get_targets_batch(member_ids)
+            for i in legacy:
+                counts[i] = sum(1 for tid in formations[i]["members"] if tid in cached)
+
+        return counts
+
     # ==================== 时间序列查询 ====================
 
     def get_formations_by_time_range(self, start: datetime, end: datetime,
-                                     limit: int = 100) -> List[Dict[str, Any]]:
+                                     limit: int = 100,
+                                     desc: bool = False) -> List[Dict[str, Any]]:
         """
         按时间范围查询编队
 
@@ -157,38 +259,33 @@ class FormationStore:
             start: 开始时间
             end: 结束时间
             limit: 最大返回数量
+            desc: 是否按时间从新到旧返回（默认从旧到新）
         """
         try:
             timeline_key = self._make_timeline_key()
-
-            # 使用Sorted Set按分数范围查询
-            start_score = start.timestamp()
-            end_score = end.timestamp()
-
-            formation_ids = self.redis.zrangebyscore(
-                timeline_key,
-                start_score,
-                end_score
+            key_prefix = self._make_formation_key("")
+            tracks_suffix = self._make_tracks_key("")[len(key_prefix):]
+
+            # 索引查询与详情读取在同一次脚本调用中完成（一次往返）
+            formation_ids, summaries, tracks, legacy = self._time_range_script(
+                keys=[timeline_key],
+                args=[start.timestamp(), end.timestamp(), limit, int(desc),
+                      key_prefix, tracks_suffix]
             )
+            formation_ids = [fid.decode() if isinstance(fid, bytes) else fid
+                             for fid in formation_ids]
 
-            # 限制数量
-            formation_ids = formation_ids[:limit]
-
-            # 批量获取详情
-            results = []
-            for fid in formation_ids:
-                data = self.get_formation(fid)
-                if data:
-                    results.append(data)
-
-            return results
+            return self._decode_formations(
+                formation_ids, summaries, tracks,
+                legacy={i - 1 for i in legacy}
+            )
 
         except Exception as e:
             logger.error(f"时间范围查询失败: {e}")
             return []
 
-    def get_formations_by_date(self, date: datetime,
-                               limit: int = 1000) -> List[Dict[str, Any]]:
+    def get_formations_by_date(self, date: datetime, limit: int = 1000,
+                               include_tracks: bool = True) -> List[Dict[str, Any]]:
         """获取某一天的编队"""
         try:
             date_str = date.strftime("%Y%m%d")
@@ -198,20 +295,83 @@ class FormationStore:
             formation_ids = [fid.decode() if isinstance(fid, bytes) else fid
                              for fid in formation_ids]
 
-            results = []
-            for fid in formation_ids:
-                data = self.get_formation(fid)
-                if data:
-                    results.append(data)
-
-            return results
+            return self._get_formations(formation_ids, include_tracks)
 
         except Exception as e:
             logger.error(f"按日期查询失败 [{date_str}]: {e}")
             return []
 
-    def get_latest_formations(self, count: int = 10) -> List[Dict[str, Any]]:
-        """获取最新的编队"""
+    def _get_formations(self, formation_ids: List[str],
+                        include_tracks: bool = True) -> List[Dict[str, Any]]:
+        """
+        管道批量获取编队详情
+
+        Args:
+            formation_ids: 编队ID列表（结果保持该顺序，已过期的跳过）
+            include_tracks: 为False时只读摘要，不从Redis拉取完整航迹
+        """
+        pipe = self.redis.pipeline()
+        for fid in formation_ids:
+            pipe.get(self._make_formation_key(fid))
+            if include_tracks:
+                pipe.get(self._make_tracks_key(fid))
+
+        raw = pipe.execute(raise_on_error=False)
+        step = 2 if include_tracks else 1
+        summaries = raw[::step]
+
+        return self._decode_formations(
+            formation_ids, summaries,
+            raw[1::2] if include_tracks else None,
+            # 旧版Hash存储读取摘要时返回WRONGTYPE
+            legacy={i for i, summary in enumerate(summaries) if isinstance(summary, Exception)}
+        )
+
+    def _decode_formations(self, formation_ids: List[str], summaries: List[Any],
+                           tracks: Optional[List[Any]], legacy: set) -> List[Dict[str, Any]]:
+        """
+        反序列化批量读取的编队数据
+
+        Args:
+            formation_ids: 编队ID列表（结果保持该顺序，已过期的跳过）
+            summaries: 与ID一一对应的摘要数据
+            tracks: 与ID一一对应的完整航迹数据，None表示未读取航迹
+            legacy: 旧版Hash存储的下标集合
+        """
+        include_tracks = tracks is not None
+
+        results = []
+        for i, fid in enumerate(formation_ids):
+            summary = summaries[i]
+
+            if i in legacy:
+                # 旧版Hash存储，按字段读取
+                data = self._get_legacy_formation(fid, include_tracks)
+            elif summary is None:
+                continue
+            else:
+                data = self.redis._deserialize(summary)
+                if include_tracks:
+                    track = tracks[i]
+                    if track is not None and not isinstance(track, Exception):
+                        data["full_tracks"] = self.redis._deserialize(track)
+
+            if data:
+                results.append(data)
+
+        return results
+
+    def _get_legacy_formation(self, formation_id: str,
+                              include_tracks: bool) -> Dict[str, Any]:
+        """读取旧版Hash存储的编队（过渡期兼容，7天后随TTL自然淘汰）"""
+        key = self._make_formation_key(formation_id)
+        if include_tracks:
+            return self.redis.hgetall(key)
+        return self.redis.hmget(key, list(FORMATION_SUMMARY_FIELDS))
+
+    def get_latest_formations(self, count: int = 10,
+                              include_tracks: bool = True) -> List[Dict[str, Any]]:
+        """获取最新的编队（include_tracks=False 时不读取完整航迹字段）"""
         try:
             timeline_key = self._make_timeline_key()
 
@@ -224,13 +384,7 @@ class FormationStore:
             formation_ids = [fid.decode() if isinstance(fid, bytes) else fid
                              for fid in formation_ids]
 
-            results = []
-            for fid in formation_ids:
-                data = self.get_formation(fid)
-                if data:
-                    results.append(data)
-
-            return results
+            return self._get_formations(formation_ids, include_tracks)
 
         except Exception as e:
             logger.error(f"获取最新编队失败: {e}")
@@ -249,18 +403,41 @@ class FormationStore:
             total_confidence = 0.0
             confidence_count = 0
 
-            for i in range(days):
-                date = datetime.now() - timedelta(days=i)
+            now = datetime.now()
+            dates = [now - timedelta(days=i) for i in range(days)]
+
+            # 各日索引数量与日统计一次管道读取
+            pipe = self.redis.pipeline()
+            for date in dates:
                 date_str = date.strftime("%Y%m%d")
+                pipe.zcard(self._make_daily_key(date_str))
+                pipe.hgetall(self._make_daily_stats_key(date_str))
+            raw = pipe.execute()
 
-                daily_key = self._make_daily_key(date_str)
-                count = self.redis.zcard(daily_key)
+            for i, date in enumerate(dates):
+                date_str = date.strftime("%Y%m%d")
+                count, day_stats = raw[2 * i], raw[2 * i + 1]
 
                 stats["daily_counts"][date_str] = count
                 stats["total_count"] += count
 
-                # 获取类型分布
-                formations = self.get_formations_by_date(date, limit=1000)
+                if day_stats:
+                    # 使用写入时累加的日统计
+                    for field, value in day_stats.items():
+                        field = field.decode()
+                        if field.startswith("type:") and int(value) > 0:
+                            f_type = field[5:]
+                            stats["type_distribution"][f_type] = \
+                                stats["type_distribution"].get(f_type, 0) + int(value)
+                    total_confidence += float(day_stats.get(b"confidence_sum", 0))
+                    confidence_count += int(day_stats.get(b"count", 0))
+                    continue
+
+                if not count:
+                    continue
+
+                # 无日统计的旧数据：读取编队摘要计算类型分布
+                formations = self.get_formations_by_date(date, limit=1000, include_tracks=False)
                 for f in formations:
                     f_type = f.get("formation_type", "Unknown")
                     stats["type_distribution"][f_type] = \
@@ -291,39 +468,35 @@ class FormationStore:
         try:
             stats = {"formations_removed": 0, "orphan_indexes_cleaned": 0}
 
-            # 清理时间线中指向已删除数据的索引
             timeline_key = self._make_timeline_key()
+            cutoff_date = datetime.now() - timedelta(days=self.RETENTION_DAYS)
+            cutoff_score = cutoff_date.timestamp()
 
-            # 获取所有ID（这里可能需要分批处理，如果数据量很大）
-            all_ids = self.redis.zrangebyscore(
-                timeline_key,
-                0,
-                datetime.now().timestamp()
+            # 超过保留期的索引（对应数据已随TTL过期）一条命令删除
+            stats["orphan_indexes_cleaned"] += self.redis.client.zremrangebyscore(
+                timeline_key, "-inf", cutoff_score
             )
 
-            to_remove = []
-            for fid in all_ids:
-                fid_str = fid.decode() if isinstance(fid, bytes) else fid
-                if not self.redis.exists(self._make_formation_key(fid_str)):
-                    to_remove.append(fid_str)
-
-            if to_remove:
-                self.redis.client.zrem(timeline_key, *to_remove)
-                stats["orphan_indexes_cleaned"] = len(to_remove)
-
-            # 清理旧的日索引（超过7天）
-            cutoff_date = datetime.now() - timedelta(days=self.RETENTION_DAYS)
-            for i in range(30):  # 检查最近30天的索引
-                check_date = datetime.now() - timedelta(days=i)
-                date_str = check_date.strftime("%Y%m%d")
-                daily_key = self._make_daily_key(date_str)
-
-                if check_date < cutoff_date:
-                    # 删除旧索引
-                    count = self.redis.zcard(daily_key)
-                    if count > 0:
-                        self.redis.delete(daily_key)
-                        stats["formations_removed"] += count
+            # 保留期内提前删除的数据：在Redis端分块检查并移除索引
+            stats["orphan_indexes_cleaned"] += self._remove_orphan_indexes(timeline_key)
+
+            # 清理旧的日索引（超过7天），SCAN遍历日索引key
+            old_daily_keys = []
+            for key in self.redis.client.scan_iter(match=self._make_daily_key("*"), count=1000):
+                key = key.decode() if isinstance(key, bytes) else key
+                date_str = key.rsplit(":", 1)[-1]
+                try:
+                    if datetime(int(date_str[:4]), int(date_str[4:6]), int(date_str[6:8])) < cutoff_date:
+                        old_daily_keys.append(key)
+                except ValueError:
+                    continue
+
+            if old_daily_keys:
+                pipe = self.redis.pipeline()
+                for key in old_daily_keys:
+                    pipe.zcard(key)
+                stats["formations_removed"] += sum(pipe.execute())
+                self.redis.delete(*old_daily_keys)
 
             logger.info(f"数据清理完成: {stats}")
             return stats
@@ -332,6 +505,151 @@ class FormationStore:
             logger.error(f"清理过期数据失败: {e}")
             return {}
 
+    def _remove_orphan_indexes(self, timeline_key: str, chunk_size: int = 1000) -> int:
+        """
+        移除时间线中指向已删除数据的索引
+
+        每次脚本调用在Redis端检查一块ID（ZRANGEBYSCORE + EXISTS + ZREM），
+        往返次数为 O(N / chunk_size)
+
+        Returns:
+            移除的索引数量
+        """
+        removed_total = 0
+        offset = 0
+        key_prefix = self._make_formation_key("")
+
+        while True:
+            scanned, removed = self._orphan_script(
+                keys=[timeline_key],
+                args=[offset, chunk_size, key_prefix]
+            )
+            removed_total += removed
+            if scanned < chunk_size:
+                return removed_total
+            # 被移除的成员不再占位，偏移只前进保留下来的数量
+            offset += scanned - removed
+
+    @property
+    def _orphan_script(self):
+        """孤立索引清理脚本（首次使用时注册）"""
+        if self._orphan_script_obj is None:
+            self._orphan_script_obj = self.redis.client.register_script(_ORPHAN_INDEX_SCRIPT)
+        return self._orphan_script_obj
+
+    @property
+    def _store_script(self):
+        """批量存储脚本（首次使用时注册）"""
+        if self._store_script_obj is None:
+            self._store_script_obj = self.redis.client.register_script(_STORE_SCRIPT)
+        return self._store_script_obj
+
+    @property
+    def _decrement_stats_script(self):
+        """日统计扣除脚本（首次使用时注册）"""
+        if self._decrement_stats_script_obj is None:
+            self._decrement_stats_script_obj = self.redis.client.register_script(_DECREMENT_STATS_SCRIPT)
+        return self._decrement_stats_script_obj
+
+    @property
+    def _time_range_script(self):
+        """时间范围查询脚本（首次使用时注册）"""
+        if self._time_range_script_obj is None:
+            self._time_range_script_obj = self.redis.client.register_script(_TIME_RANGE_SCRIPT)
+        return self._time_range_script_obj
+
+
+# 分块清理孤立索引：KEYS[1]=时间线key，ARGV=[偏移, 数量, 编队key前缀]
+_ORPHAN_INDEX_SCRIPT = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', '+inf', 'LIMIT', ARGV[1], ARGV[2])
+local removed = 0
+for _, id in ipairs(ids) do
+    if redis.call('EXISTS', ARGV[3] .. id) == 0 then
+        redis.call('ZREM', KEYS[1], id)
+        removed = removed + 1
+    end
+end
+return {#ids, removed}
+"""
+
+
+# 批量存储：KEYS[1]=时间线key，
+# ARGV=[编队key前缀, 航迹key后缀, 成员key后缀, 日索引key前缀, 日统计key前缀, TTL,
+#       然后每个编队依次为 ID, 分数, 日期, 摘要, 航迹(空串表示无), 类型, 置信度, 成员数, 成员ID...]
+_STORE_SCRIPT = """
+local prefix, tracks_suffix, members_suffix = ARGV[1], ARGV[2], ARGV[3]
+local daily_prefix, stats_prefix, ttl = ARGV[4], ARGV[5], ARGV[6]
+local i = 7
+while i <= #ARGV do
+    local fid, score, date = ARGV[i], ARGV[i + 1], ARGV[i + 2]
+    local n = tonumber(ARGV[i + 7])
+    local key = prefix .. fid
+
+    redis.call('SET', key, ARGV[i + 3], 'EX', ttl)
+    if ARGV[i + 4] ~= '' then
+        redis.call('SET', key .. tracks_suffix, ARGV[i + 4], 'EX', ttl)
+    end
+    if n > 0 then
+        redis.call('SADD', key .. members_suffix, unpack(ARGV, i + 8, i + 7 + n))
+        redis.call('EXPIRE', key .. members_suffix, ttl)
+    end
+
+    redis.call('ZADD', KEYS[1], score, fid)
+    redis.call('ZADD', daily_prefix .. date, score, fid)
+    redis.call('EXPIRE', daily_prefix .. date, ttl)
+
+    local stats = stats_prefix .. date
+    redis.call('HINCRBY', stats, 'count', 1)
+    redis.call('HINCRBYFLOAT', stats, 'confidence_sum', ARGV[i + 6])
+    redis.call('HINCRBY', stats, 'type:' .. ARGV[i + 5], 1)
+    redis.call('EXPIRE', stats, ttl)
+
+    i = i + 8 + n
+end
+return 1
+"""
+
+
+# 日统计扣除：KEYS[1]=日统计key，ARGV=[置信度, 类型]
+# 统计不存在（已过期）时跳过，检查与扣减在同一脚本内执行，不会重建无TTL的负数统计
+_DECREMENT_STATS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HINCRBY', KEYS[1], 'count', -1)
+redis.call('HINCRBYFLOAT', KEYS[1], 'confidence_sum', -tonumber(ARGV[1]))
+redis.call('HINCRBY', KEYS[1], 'type:' .. ARGV[2], -1)
+return 1
+"""
+
+
+# 时间范围查询：KEYS[1]=时间线key，ARGV=[起始分数, 结束分数, 数量, 是否倒序, 编队key前缀, 航迹key后缀(空串表示不读航迹)]
+# 返回 {ID列表, 摘要列表, 航迹列表, 旧版Hash存储的下标列表(从1开始)}
+_TIME_RANGE_SCRIPT = """
+local ids
+if ARGV[4] == '1' then
+    ids = redis.call('ZREVRANGEBYSCORE', KEYS[1], ARGV[2], ARGV[1], 'LIMIT', 0, ARGV[3])
+else
+    ids = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1], ARGV[2], 'LIMIT', 0, ARGV[3])
+end
+local summaries, tracks, legacy = {}, {}, {}
+for i, id in ipairs(ids) do
+    local key = ARGV[5] .. id
+    local kind = redis.call('TYPE', key)['ok']
+    summaries[i] = false
+    tracks[i] = false
+    if kind == 'string' then
+        summaries[i] = redis.call('GET', key)
+        if ARGV[6] ~= '' then
+            tracks[i] = redis.call('GET', key .. ARGV[6])
+        end
+    elseif kind == 'hash' then
+        table.insert(legacy, i)
+    end
+end
+return {ids, summaries, tracks, legacy}
+"""
+
 
 # 全局FormationStore实例
 formation_store = FormationStore()
\ No newline at end of file
@@ -1,16 +1,28 @@
 """
 Redis客户端管理 - 连接池、序列化、错误处理
 """
+import os
+import socket
+import threading
 import redis
 import msgpack
 import orjson
 from typing import Any, Optional, Dict, List, Union
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import logging
 from contextlib import contextmanager
+from functools import lru_cache
 
 logger = logging.getLogger(__name__)
 
+# msgpack扩展类型编号（带时区的datetime使用msgpack内置Timestamp扩展）
+_EXT_NAIVE_DATETIME = 1  # 不带时区的datetime：按UTC编码墙上时间，解码后去掉时区
+_EXT_SET = 2
+
+# 存储值的格式标记前缀（_serialize_fast写入；无前缀的为msgpack旧数据）
+_TAG_ORJSON = 0x01
+_TAG_MSGPACK = 0x02
+
 
 class RedisConfig:
     """Redis配置"""
@@ -18,6 +30,8 @@ class RedisConfig:
     PORT = 6379
     DB = 0
     PASSWORD = None
+    # 与Redis同机部署时使用UNIX域套接字（设置后忽略HOST/PORT）
+    UNIX_SOCKET_PATH = os.getenv("REDIS_UNIX_SOCKET_PATH") or None
 
     # 连接池配置
     MAX_CONNECTIONS = 50
@@ -25,6 +39,11 @@ class RedisConfig:
     SOCKET_CONNECT_TIMEOUT = 5
     RETRY_ON_TIMEOUT = True
     HEALTH_CHECK_INTERVAL = 30
+    POOL_WARMUP_CONNECTIONS = 8  # 启动时预建的连接数
+    SOCKET_KEEPALIVE = True
+    KEEPALIVE_IDLE = 60  # 空闲多少秒后开始发送keepalive探测
+    KEEPALIVE_INTERVAL = 10
+    KEEPALIVE_COUNT = 3
 
     # Key前缀
     KEY_PREFIX = "formation:"
@@ -33,7 +52,23 @@ class RedisConfig:
     TARGET_TTL = 86400  # 目标状态缓存24小时
     FORMATION_TTL = 604800  # 编队结果保留7天
     DELTA_STREAM_TTL = 604800  # 增量流保留7天
+    DELTA_STREAM_MAXLEN = 10000  # 单目标增量流最大事件数（近似裁剪）
+    DELTA_STREAM_EXPIRE_INTERVAL = 60  # 每个增量流刷新TTL的最小间隔（秒）
+    DELTA_STREAM_EXPIRE_TRACKED = 10000  # 记录刷新时间的增量流数量上限（超出时清理过期记录）
     SYNC_SESSION_TTL = 3600  # 同步会话1小时
+    RECOGNIZE_CACHE_TTL = 2  # 识别结果去重缓存2秒
+
+    # 跨进程事件总线（WebSocket广播）
+    EVENT_STREAM = "events"
+    EVENT_STREAM_MAXLEN = 10000
+    EVENT_READ_BLOCK_MS = 1000
+    WS_SUBSCRIPTIONS = "ws:subscriptions"  # Hash {target_id: 订阅该目标的进程数}
+
+
+@lru_cache(maxsize=65536)
+def _build_key(prefix: str, parts: tuple) -> str:
+    """拼接带前缀的key（缓存结果，同一key重复构建时直接复用字符串）"""
+    return f"{prefix}{':'.join(parts)}"
 
 
 class RedisClient:
@@ -41,6 +76,7 @@ class RedisClient:
 
     _instance = None
     _pool = None
+    _local = threading.local()  # 每个线程复用的msgpack Packer
 
     def __new__(cls):
         if cls._instance is None:
@@ -52,8 +88,6 @@ class RedisClient:
         """初始化连接池"""
         try:
             self._pool = redis.ConnectionPool(
-                host=RedisConfig.HOST,
-                port=RedisConfig.PORT,
                 db=RedisConfig.DB,
                 password=RedisConfig.PASSWORD,
                 max_connections=RedisConfig.MAX_CONNECTIONS,
@@ -61,14 +95,67 @@ class RedisClient:
                 socket_connect_timeout=RedisConfig.SOCKET_CONNECT_TIMEOUT,
                 retry_on_timeout=RedisConfig.RETRY_ON_TIMEOUT,
                 health_check_interval=RedisConfig.HEALTH_CHECK_INTERVAL,
-                decode_responses=False  # 保持bytes，手动处理序列化
+                decode_responses=False,  # 保持bytes，手动处理序列化
+                **self._transport_options()
             )
             self._redis = redis.Redis(connection_pool=self._pool)
-            logger.info("Redis连接池初始化成功")
+            logger.info(f"Redis连接池初始化成功 ({RedisConfig.UNIX_SOCKET_PATH or 'TCP'})")
         except Exception as e:
             logger.error(f"Redis连接池初始化失败: {e}")
             raise
 
+        self._warmup_pool()
+
+    def _transport_options(self) -> Dict[str, Any]:
+        """
+        连接方式相关的连接池参数
+
+        配置了 UNIX_SOCKET_PATH 时走UNIX域套接字，省去TCP/IP协议栈开销；
+        否则走TCP（redis-py建连时已设置 TCP_NODELAY，小批量管道不受Nagle延迟影响）
+        """
+        if RedisConfig.UNIX_SOCKET_PATH:
+            return {
+                "connection_class": redis.UnixDomainSocketConnection,
+                "path": RedisConfig.UNIX_SOCKET_PATH,
+            }
+        return {
+            "host": RedisConfig.HOST,
+            "port": RedisConfig.PORT,
+            "socket_keepalive": RedisConfig.SOCKET_KEEPALIVE,
+            "socket_keepalive_options": self._keepalive_options(),
+        }
+
+    @staticmethod
+    def _keepalive_options() -> Dict[int, int]:
+        """TCP keepalive参数（防止空闲连接被中间设备静默断开；非Linux平台缺少的选项跳过）"""
+        options = {}
+        for name, value in (("TCP_KEEPIDLE", RedisConfig.KEEPALIVE_IDLE),
+                            ("TCP_KEEPINTVL", RedisConfig.KEEPALIVE_INTERVAL),
+                            ("TCP_KEEPCNT", RedisConfig.KEEPALIVE_COUNT)):
+            if hasattr(socket, name):
+                options[getattr(socket, name)] = value
+        return options
+
+    def _warmup_pool(self):
+        """预建连接并PING，首批请求无需同步建连（Redis不可用时只记录警告）"""
+        count = min(RedisConfig.POOL_WARMUP_CONNECTIONS, RedisConfig.MAX_CONNECTIONS)
+        connections = []
+        try:
+            for _ in range(count):
+                conn = self._pool.get_connection()
+                connections.append(conn)
+                conn.send_command("PING")
+            for conn in connections:
+                conn.read_response()
+            logger.info(f"Redis连接池预热完成: {len(connections)} 个连接")
+        except Exception as e:
+            logger.warning(f"Redis连接池预热失败: {e}")
+            for conn in connections:
+                conn.disconnect()
+        finally:
+            for conn in connections:
+                self._pool.release(conn)
+
     @property
     def client(self) -> redis.Redis:
         """获取Redis客户端"""
@@ -86,40 +173,106 @@ class RedisClient:
 
     def _make_key(self, *parts: str) -> str:
         """构建带前缀的key"""
-        return f"{RedisConfig.KEY_PREFIX}{':'.join(parts)}"
+        return _build_key(RedisConfig.KEY_PREFIX, parts)
 
     def _serialize(self, data: Any) -> bytes:
-        """序列化数据（使用msgpack，比JSON更快更紧凑）"""
+        """序列化数据（使用msgpack，比JSON更快更紧凑；datetime编码为二进制Timestamp）"""
         try:
-            return msgpack.packb(data, default=self._default_encoder, use_bin_type=True)
+            return self._packer.pack(data)
         except Exception as e:
             logger.error(f"序列化失败: {e}")
             raise
 
+    @property
+    def _packer(self) -> msgpack.Packer:
+        """
+        当前线程的msgpack Packer
+
+        packb每次调用都会新建Packer并分配缓冲区，复用后只保留编码本身的开销；
+        Packer不是线程安全的，因此按线程各建一个
+        """
+        packer = getattr(self._local, "packer", None)
+        if packer is None:
+            packer = msgpack.Packer(default=self._default_encoder, use_bin_type=True,
+                                    datetime=True)
+            self._local.packer = packer
+        return packer
+
+    def _serialize_fast(self, data: Any) -> bytes:
+        """
+        序列化数据（快速路径）
+
+        纯JSON兼容的数据用orjson编码并加 0x01 前缀；含datetime、set、bytes、非字符串键等
+        类型时退回msgpack并加 0x02 前缀，保证读取时类型不变
+        """
+        try:
+            return b"\x01" + orjson.dumps(data, option=orjson.OPT_PASSTHROUGH_DATETIME)
+        except TypeError:
+            return b"\x02" + self._serialize(data)
+
     def _deserialize(self, data: bytes) -> Any:
-        """反序列化数据"""
+        """
+        反序列化数据
+
+        兼容 _serialize_fast 的格式前缀；msgpack中 0x01/0x02 只能是单字节整数，
+        因此长度大于1且以其开头的一定是带前缀的数据
+        """
         if data is None:
             return None
         try:
-            return msgpack.unpackb(data, raw=False)
+            if len(data) > 1:
+                if data[0] == _TAG_ORJSON:
+                    # 直接切片比memoryview更快（小值开销更低，大值拷贝成本相对解析可忽略）
+                    return orjson.loads(data[1:])
+                if data[0] == _TAG_MSGPACK:
+                    data = memoryview(data)[1:]
+            return msgpack.unpackb(data, raw=False, timestamp=3, ext_hook=self._ext_hook)
         except Exception as e:
             logger.error(f"反序列化失败: {e}")
             raise
 
+    def _deserialize_hash(self, data: Dict[bytes, bytes]) -> Dict[str, Any]:
+        """
+        反序列化Hash的全部字段（用于管道中的hgetall结果）
+
+        orjson格式的字段在循环内直接解析，省去逐字段的方法调用；其余格式交给 _deserialize
+        """
+        loads = orjson.loads
+        deserialize = self._deserialize
+        result = {}
+        for k, v in data.items():
+            if len(v) > 1 and v[0] == _TAG_ORJSON:
+                result[k.decode()] = loads(v[1:])
+            else:
+                result[k.decode()] = deserialize(v)
+        return result
+
     def _default_encoder(self, obj):
-        """处理特殊类型编码"""
+        """处理特殊类型编码（带时区的datetime由msgpack直接编码，不经过此处）"""
         if isinstance(obj, datetime):
-            return {"__datetime__": obj.isoformat()}
+            ts = msgpack.Timestamp.from_datetime(obj.replace(tzinfo=timezone.utc))
+            return msgpack.ExtType(_EXT_NAIVE_DATETIME, ts.to_bytes())
         if isinstance(obj, set):
-            return {"__set__": list(obj)}
+            # 在Packer编码过程中回调，不能重入同一个Packer
+            return msgpack.ExtType(_EXT_SET, msgpack.packb(
+                list(obj), default=self._default_encoder, use_bin_type=True, datetime=True
+            ))
         raise TypeError(f"无法序列化类型: {type(obj)}")
 
+    def _ext_hook(self, code: int, data: bytes) -> Any:
+        """处理扩展类型解码"""
+        if code == _EXT_NAIVE_DATETIME:
+            return msgpack.Timestamp.from_bytes(data).to_datetime().replace(tzinfo=None)
+        if code == _EXT_SET:
+            return set(self._deserialize(data))
+        return msgpack.ExtType(code, data)
+
     # ==================== 基础操作封装 ====================
 
     def set(self, key: str, value: Any, ttl: Optional[int] = None) -> bool:
         """设置值"""
         try:
-            serialized = self._serialize(value)
+            serialized = self._serialize_fast(value)
             if ttl:
                 return self._redis.setex(key, ttl, serialized)
             return self._redis.set(key, serialized)
@@ -173,7 +326,7 @@ class RedisClient:
     def hset(self, key: str, field: str, value: Any) -> bool:
         """Hash设置字段"""
         try:
-            serialized = self._serialize(value)
+            serialized = self._serialize_fast(value)
             return self._redis.hset(key, field, serialized) == 1
         except Exception as e:
             logger.error(f"Redis hset失败 [{key}.{field}]: {e}")
@@ -201,7 +354,7 @@ class RedisClient:
         """Hash获取所有字段"""
         try:
             data = self._redis.hgetall(key)
-            return {k.decode(): self._deserialize(v) for k, v in data.items()}
+            return self._deserialize_hash(data)
         except Exception as e:
             logger.error(f"Redis hgetall失败 [{key}]: {e}")
             return {}
@@ -226,10 +379,20 @@ class RedisClient:
             return 0
 
     def zrangebyscore(self, key: str, min_score: float, max_score: float,
-                      withscores: bool = False) -> Union[List[str], List[tuple]]:
-        """按分数范围获取"""
+                      withscores: bool = False, start: Optional[int] = None,
+                      num: Optional[int] = None, desc: bool = False) -> Union[List[str], List[tuple]]:
+        """
+        按分数范围获取
+
+        start/num 对应 LIMIT offset count（在Redis端截取）；desc=True 时按分数从高到低（ZREVRANGEBYSCORE）
+        """
         try:
-            results = self._redis.zrangebyscore(key, min_score, max_score, withscores=withscores)
+            if desc:
+                results = self._redis.zrevrangebyscore(key, max_score, min_score, start=start,
+                                                       num=num, withscores=withscores)
+            else:
+                results = self._redis.zrangebyscore(key, min_score, max_score, start=start,
+                                                    num=num, withscores=withscores)
             if withscores:
                 return [(r[0].decode(), r[1]) for r in results]
             return [r.decode() for r in results]
@@ -255,12 +418,14 @@ class RedisClient:
 
     # ==================== Stream操作（增量同步） ====================
 
-    def xadd(self, stream: str, fields: Dict[str, Any], maxlen: Optional[int] = None) -> Optional[str]:
-        """Stream添加消息"""
+    def xadd(self, stream: str, fields: Dict[str, Any], maxlen: Optional[int] = None,
+             id: str = "*", approximate: bool = False) -> Optional[str]:
+        """Stream添加消息（approximate=True 时按 MAXLEN ~ 近似裁剪）"""
         try:
             # 序列化所有字段
             serialized = {k: self._serialize(v) for k, v in fields.items()}
-            return self._redis.xadd(stream, serialized, maxlen=maxlen)
+            return self._redis.xadd(stream, serialized, id=id, maxlen=maxlen,
+                                    approximate=approximate)
         except Exception as e:
             logger.error(f"Redis xadd失败 [{stream}]: {e}")
             return None
@@ -294,9 +459,13 @@ class RedisClient:
 
     # ==================== 批量操作 ====================
 
-    def pipeline(self):
-        """获取管道（用于批量操作）"""
-        return self._redis.pipeline()
+    def pipeline(self, transaction: bool = False):
+        """
+        获取管道（用于批量操作）
+
+        默认不使用 MULTI/EXEC 事务包裹，仅批量发送命令；需要原子性时传入 transaction=True
+        """
+        return self._redis.pipeline(transaction=transaction)
 
     def mget(self, keys: List[str]) -> Dict[str, Any]:
         """批量获取"""
@@ -312,7 +481,7 @@ class RedisClient:
         try:
             pipe = self.pipeline()
             for key, value in mapping.items():
-                serialized = self._serialize(value)
+                serialized = self._serialize_fast(value)
                 if ttl:
                     pipe.setex(key, ttl, serialized)
                 else:
@@ -1,23 +1,70 @@
 """
 TargetState缓存管理 - 支持增量检测和版本控制
 """
-import hashlib
 import logging
-from typing import Dict, List, Optional, Tuple, Any
+import struct
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple, Any
 from datetime import datetime, timedelta
 from dataclasses import asdict
+from functools import lru_cache
+
+import xxhash
 
 from cache.redis_client import redis_client, RedisConfig
 from models import TargetState, GeoPosition
 
 logger = logging.getLogger(__name__)
 
+# 增量判定阈值（变化量不超过阈值视为未变化）
+_LONLAT_EPS = 1e-7  # 经纬度（度）
+_ALT_EPS = 1e-2  # 高度（米）
+_MOTION_EPS = 1e-2  # 航向（度）/ 速度（m/s）
+
+# 读取目标状态时需要的字段（不读 _cached_at 等诊断字段；position 为旧版嵌套格式）
+_STATE_READ_FIELDS = ("timestamp", "lon", "lat", "alt", "heading", "speed", "pitch", "roll",
+                      "_hash", "_version", "position")
+
+_HASH_FIELD_INDEX = _STATE_READ_FIELDS.index("_hash")
+
+# 状态条件写入冲突时的最大尝试次数
+_STATE_WRITE_RETRIES = 3
+
+# 增量流消息中存放整个事件的字段名
+_DELTA_PAYLOAD_FIELD = "p"
+
+# 状态指纹的二进制布局（定点整数）：经纬度(1e-7度)、高度(厘米)、航向/速度(0.01)、时间戳(毫秒)
+_STATE_HASH_STRUCT = struct.Struct("<5iq")
+# 超出定点范围时的后备布局（原始浮点值，长度不同，与定点布局不会混淆）
+_STATE_HASH_RAW_STRUCT = struct.Struct("<6d")
+
+
+class TargetKeys(NamedTuple):
+    """单个目标使用的Redis key"""
+    state: str
+    version: str
+    delta: str
+
+
+@lru_cache(maxsize=10000)
+def _target_keys(target_id: str) -> TargetKeys:
+    """目标的状态/版本/增量流key（按目标缓存，热点目标每次更新无需重复拼接）"""
+    return TargetKeys(
+        redis_client._make_key("target", target_id),
+        redis_client._make_key("target", target_id, "version"),
+        redis_client._make_key("delta", target_id)
+    )
+
 
 class TargetCache:
     """目标状态缓存管理器"""
 
     def __init__(self):
         self.redis = redis_client
+        # 各增量流在本进程内最近一次刷新TTL的时间（monotonic）
+        self._delta_ttl_refreshed: Dict[str, float] = {}
+        self._state_write_script_obj = None
+        self._delta_append_script_obj = None
 
     def _make_target_key(self, target_id: str) -> str:
         """构建目标缓存key"""
@@ -31,21 +78,42 @@ class TargetCache:
         """构建增量流key"""
         return self.redis._make_key("delta", target_id)
 
+    def _keys_for(self, target_id: str) -> TargetKeys:
+        """目标的状态/版本/增量流key（模块级缓存，不持有实例引用）"""
+        return _target_keys(target_id)
+
+    @property
+    def live_targets_key(self) -> str:
+        """存活目标索引key（Sorted Set，score为状态过期时间戳）"""
+        return self.redis._make_key("targets", "live")
+
     def _compute_state_hash(self, state: TargetState) -> str:
         """计算状态哈希（用于快速对比）"""
-        # 提取关键字段计算哈希
-        data = f"{state.position.longitude:.6f}|{state.position.latitude:.6f}|{state.position.altitude:.1f}|{state.heading:.2f}|{state.speed:.2f}|{state.timestamp.isoformat()}"
-        return hashlib.md5(data.encode()).hexdigest()
+        # 关键字段按增量判定精度量化为定点整数后打包计算xxh3（仅用于变更检测，无需加密哈希）
+        position = state.position
+        ts = state.timestamp.timestamp()
+        try:
+            data = _STATE_HASH_STRUCT.pack(
+                round(position.longitude * 1e7), round(position.latitude * 1e7),
+                round(position.altitude * 100),
+                round(state.heading * 100), round(state.speed * 100),
+                round(ts * 1000)
+            )
+        except (struct.error, ValueError, OverflowError):
+            # 超出定点范围（如0~360经度、异常高度）或NaN/inf：直接对原始浮点值计算
+            data = _STATE_HASH_RAW_STRUCT.pack(
+                position.longitude, position.latitude, position.altitude,
+                state.heading, state.speed, ts
+            )
+        return format(xxhash.xxh3_64_intdigest(data), "016x")
 
     def _state_to_dict(self, state: TargetState) -> Dict[str, Any]:
-        """状态转换为字典（可序列化）"""
+        """状态转换为字典（可序列化；位置拆为 lon/lat/alt 扁平字段，时间戳为epoch秒）"""
         return {
-            "timestamp": state.timestamp.isoformat(),
-            "position": {
-                "longitude": state.position.longitude,
-                "latitude": state.position.latitude,
-                "altitude": state.position.altitude
-            },
+            "timestamp": state.timestamp.timestamp(),
+            "lon": state.position.longitude,
+            "lat": state.position.latitude,
+            "alt": state.position.altitude,
             "heading": state.heading,
             "speed": state.speed,
             "pitch": state.pitch,
@@ -55,20 +123,43 @@ class TargetCache:
 
     def _dict_to_state(self, data: Dict[str, Any]) -> TargetState:
         """字典转换为状态"""
-        pos_data = data["position"]
+        lon, lat, alt = self._position_of(data)
         return TargetState(
-            timestamp=datetime.fromisoformat(data["timestamp"]),
-            position=GeoPosition(
-                longitude=pos_data["longitude"],
-                latitude=pos_data["latitude"],
-                altitude=pos_data["altitude"]
-            ),
+            timestamp=self._timestamp_of(data),
+            position=GeoPosition(longitude=lon, latitude=lat, altitude=alt),
             heading=data["heading"],
             speed=data["speed"],
             pitch=data.get("pitch", 0.0),
             roll=data.get("roll", 0.0)
         )
 
+    def _decode_state_fields(self, values: List[Optional[bytes]]) -> Dict[str, Any]:
+        """HMGET(_STATE_READ_FIELDS) 的结果转换为状态字典（不存在的字段跳过）"""
+        deserialize = self.redis._deserialize
+        return {field: deserialize(value)
+                for field, value in zip(_STATE_READ_FIELDS, values) if value is not None}
+
+    @staticmethod
+    def _position_of(data: Dict[str, Any]) -> Tuple[float, float, float]:
+        """
+        读取位置 (经度, 纬度, 高度)
+
+        兼容旧版嵌套 position 字段（随TTL自然淘汰）；旧Hash被新格式覆盖写入后
+        position 字段仍残留，因此优先读取扁平字段
+        """
+        if "lon" in data:
+            return data["lon"], data["lat"], data["alt"]
+        pos = data["position"]
+        return pos["longitude"], pos["latitude"], pos["altitude"]
+
+    @staticmethod
+    def _timestamp_of(data: Dict[str, Any]) -> datetime:
+        """读取状态时间戳（epoch秒；兼容旧版ISO字符串，随TTL自然淘汰）"""
+        ts = data["timestamp"]
+        if isinstance(ts, str):
+            return datetime.fromisoformat(ts)
+        return datetime.fromtimestamp(ts)
+
     # ==================== 核心缓存操作 ====================
 
     def cache_target_state(self, target_id: str, state: TargetState,
@@ -79,57 +170,233 @@ class TargetCache:
         Returns:
             (是否成功, 是否增量更新, 增量数据或None)
         """
+        success, is_update, delta, _ = self._cache_one(target_id, state, emit_delta)
+        return success, is_update, delta
+
+    def _cache_one(self, target_id: str, state: TargetState,
+                   emit_delta: bool) -> Tuple[bool, bool, Optional[Dict], int]:
+        """
+        缓存单个目标状态
+
+        写入脚本按读取时的旧状态指纹条件写入；读取后被其他进程更新时重新读取并重算增量
+
+        Returns:
+            (是否成功, 是否增量更新, 增量数据或None, 版本号)
+        """
         try:
-            key = self._make_target_key(target_id)
-            version_key = self._make_version_key(target_id)
+            key = self._keys_for(target_id).state
 
             # 计算新状态哈希
             new_hash = self._compute_state_hash(state)
-            new_version = int(datetime.now().timestamp() * 1000)  # 毫秒时间戳作为版本
 
-            # 获取旧状态和版本
-            old_state_data = self.redis.hgetall(key)
-            old_version = self.redis.get(version_key) or 0
+            for _ in range(_STATE_WRITE_RETRIES):
+                new_version = time.time_ns() // 1_000_000  # 毫秒时间戳作为版本
 
-            is_update = old_state_data is not None and len(old_state_data) > 0
+                # 获取旧状态（只读取需要的字段，保留旧指纹的原始值用于条件写入）
+                raw = self.redis.client.hmget(key, _STATE_READ_FIELDS)
+                old_state_data = self._decode_state_fields(raw)
 
-            # 准备存储数据
-            state_data = self._state_to_dict(state)
-            state_data["_hash"] = new_hash
-            state_data["_version"] = new_version
+                is_update = len(old_state_data) > 0
 
-            # 使用Hash存储，便于字段级更新
-            pipe = self.redis.pipeline()
+                if is_update and old_state_data.get("_hash") == new_hash:
+                    # 状态未变化（重复上报）：只刷新过期时间，不写入数据、不产生新版本
+                    pipe = self.redis.pipeline()
+                    self._queue_ttl_refresh(pipe, target_id)
+                    pipe.execute()
+                    return True, True, None, old_state_data.get("_version", new_version)
 
-            # 存储完整状态
-            for field, value in state_data.items():
-                pipe.hset(key, field, value)
+                # 准备存储数据
+                state_data = self._state_to_dict(state)
+                state_data["_hash"] = new_hash
+                state_data["_version"] = new_version
 
-            # 设置过期时间
-            pipe.expire(key, RedisConfig.TARGET_TTL)
-            pipe.set(version_key, new_version, ex=RedisConfig.TARGET_TTL)
+                # 计算增量
+                delta = None
+                if is_update and emit_delta:
+                    delta = self._compute_delta(old_state_data, state_data)
 
-            pipe.execute()
+                # 状态、版本、存活索引与增量事件由脚本一次写入
+                if self._write_state(None, target_id, state_data, new_version, old_state_data,
+                                     raw[_HASH_FIELD_INDEX] or b"", delta):
+                    return True, is_update, delta, new_version
 
-            # 计算增量
-            delta = None
-            if is_update and emit_delta:
-                delta = self._compute_delta(old_state_data, state_data)
-                if delta:
-                    # 发布到增量流
-                    self._emit_delta_event(target_id, new_version, delta, "UPDATE")
-
-            return True, is_update, delta
+            logger.warning(f"目标状态并发写入冲突，重试后仍未写入 [{target_id}]")
+            return False, False, None, 0
 
         except Exception as e:
             logger.error(f"缓存目标状态失败 [{target_id}]: {e}")
-            return False, False, None
+            return False, False, None, 0
+
+    def cache_target_states_batch(self, items: List[Tuple[str, TargetState]],
+                                  emit_delta: bool = True) -> List[Tuple[bool, bool, Optional[Dict], int]]:
+        """
+        批量缓存目标状态（一次读管道 + 一次写管道，增量事件随写脚本一并写入）
+
+        写入冲突（读取后被其他进程更新）的目标逐个重新读取并写入；
+        单条命令出错只影响对应目标的结果
+
+        Returns:
+            与items一一对应的 (是否成功, 是否增量更新, 增量数据或None, 版本号)
+        """
+        if not items:
+            return []
+
+        try:
+            new_version = time.time_ns() // 1_000_000
+
+            # 一次往返读取所有旧状态
+            pipe = self.redis.pipeline()
+            for target_id, _ in items:
+                pipe.hmget(self._keys_for(target_id).state, _STATE_READ_FIELDS)
+            raw_states = pipe.execute(raise_on_error=False)
+
+            results = []
+            queued = []  # (结果下标, 管道中的命令起止下标, 是否为写入脚本)
+            batch_states = {}  # 同一批次内重复出现的目标，以前一条为旧状态
+            pipe = self.redis.pipeline()
+
+            for (target_id, state), raw in zip(items, raw_states):
+                if target_id in batch_states:
+                    old_state_data = batch_states[target_id]
+                    expected_hash = self.redis._serialize_fast(old_state_data["_hash"])
+                else:
+                    try:
+                        old_state_data = self._decode_state_fields(raw)
+                        expected_hash = raw[_HASH_FIELD_INDEX] or b""
+                    except Exception:
+                        old_state_data = {}
+                        expected_hash = b""
+
+                # 单个目标的数据异常（无法计算指纹/增量等）只影响该目标
+                try:
+                    is_update = len(old_state_data) > 0
+                    new_hash = self._compute_state_hash(state)
+
+                    if is_update and old_state_data.get("_hash") == new_hash:
+                        # 状态未变化：只刷新过期时间，版本号保持不变
+                        start = len(pipe)
+                        self._queue_ttl_refresh(pipe, target_id)
+                        queued.append((len(results), start, len(pipe), False))
+                        results.append((True, True, None, old_state_data.get("_version", new_version)))
+                        continue
+
+                    state_data = self._state_to_dict(state)
+                    state_data["_hash"] = new_hash
+                    state_data["_version"] = new_version
+
+                    delta = None
+                    if is_update and emit_delta:
+                        delta = self._compute_delta(old_state_data, state_data)
+
+                    start = len(pipe)
+                    self._write_state(pipe, target_id, state_data, new_version, old_state_data,
+                                      expected_hash, delta)
+                except Exception as e:
+                    logger.error(f"缓存目标状态失败 [{target_id}]: {e}")
+                    results.append((False, False, None, 0))
+                    continue
+
+                batch_states[target_id] = state_data
+                queued.append((len(results), start, start + 1, True))
+                results.append((True, is_update, delta, new_version))
+
+            replies = pipe.execute(raise_on_error=False)
+
+            for result_index, start, end, is_write in queued:
+                target_id, state = items[result_index]
+                error = next((r for r in replies[start:end] if isinstance(r, Exception)), None)
+                if error is not None:
+                    logger.error(f"缓存目标状态失败 [{target_id}]: {error}")
+                    results[result_index] = (False, False, None, 0)
+                elif is_write and not replies[start]:
+                    # 写入冲突的目标按原顺序逐个重试
+                    results[result_index] = self._cache_one(target_id, state, emit_delta)
+
+            return results
+
+        except Exception as e:
+            logger.error(f"批量缓存目标状态失败 [{len(items)}个目标]: {e}")
+            return [(False, False, None, 0)] * len(items)
+
+    def _write_state(self, client, target_id: str, state_data: Dict[str, Any], version: int,
+                     old_state_data: Dict[str, Any], expected_hash: bytes,
+                     delta: Optional[Dict]) -> Any:
+        """
+        调用状态写入脚本（client为管道时加入管道，为None时直接执行）
+
+        有旧状态时只写入与旧状态不同的字段（时间戳、版本等元数据每次都会变化），
+        首次写入时写入完整状态
+
+        Returns:
+            直接执行时返回是否写入（Redis端指纹与 expected_hash 不一致时不写入）
+        """
+        if old_state_data:
+            fields = {field: value for field, value in state_data.items()
+                      if old_state_data.get(field) != value}
+        else:
+            fields = state_data
+
+        event = b""
+        refresh_stream_ttl = 0
+        if delta:
+            event = self.redis._serialize_fast(
+                self._build_delta_event(target_id, version, delta, "UPDATE")
+            )
+            refresh_stream_ttl = int(self._should_refresh_delta_ttl(target_id))
+
+        args = [
+            expected_hash,
+            RedisConfig.TARGET_TTL,
+            self.redis._serialize(version),
+            target_id,
+            time.time() + RedisConfig.TARGET_TTL,  # 存活索引score与状态TTL一致
+            event,
+            self._delta_entry_id(version),
+            RedisConfig.DELTA_STREAM_MAXLEN,
+            refresh_stream_ttl,
+            RedisConfig.DELTA_STREAM_TTL,
+            _DELTA_PAYLOAD_FIELD,
+            len(fields),
+        ]
+        # 各字段独立序列化，与redis_client读取路径一致
+        serialize = self.redis._serialize_fast
+        for field, value in fields.items():
+            args.append(field)
+            args.append(serialize(value))
+
+        keys = self._keys_for(target_id)
+        return self._state_write_script(
+            keys=[keys.state, keys.version, self.live_targets_key, keys.delta],
+            args=args,
+            client=client
+        )
+
+    @property
+    def _state_write_script(self):
+        """状态写入脚本（首次使用时注册）"""
+        if self._state_write_script_obj is None:
+            self._state_write_script_obj = self.redis.client.register_script(_STATE_WRITE_SCRIPT)
+        return self._state_write_script_obj
+
+    @property
+    def _delta_append_script(self):
+        """增量事件追加脚本（首次使用时注册）"""
+        if self._delta_append_script_obj is None:
+            self._delta_append_script_obj = self.redis.client.register_script(_DELTA_APPEND_SCRIPT)
+        return self._delta_append_script_obj
+
+    def _queue_ttl_refresh(self, pipe, target_id: str):
+        """将状态过期时间刷新命令加入管道（状态未变化时代替写入）"""
+        keys = self._keys_for(target_id)
+        pipe.expire(keys.state, RedisConfig.TARGET_TTL)
+        pipe.expire(keys.version, RedisConfig.TARGET_TTL)
+        pipe.zadd(self.live_targets_key, {target_id: time.time() + RedisConfig.TARGET_TTL})
 
     def get_target_state(self, target_id: str) -> Optional[TargetState]:
         """获取目标当前状态"""
         try:
             key = self._make_target_key(target_id)
-            data = self.redis.hgetall(key)
+            data = self.redis.hmget(key, list(_STATE_READ_FIELDS))
 
             if not data:
                 return None
@@ -146,57 +413,93 @@ class TargetCache:
         return version or 0
 
     def get_targets_batch(self, target_ids: List[str]) -> Dict[str, TargetState]:
-        """批量获取目标状态"""
-        result = {}
-        for tid in target_ids:
-            state = self.get_target_state(tid)
-            if state:
-                result[tid] = state
-        return result
+        """批量获取目标状态（管道一次往返读取全部目标）"""
+        if len(target_ids) == 1:
+            # 单个目标直接读取，省去管道的缓冲与打包开销
+            state = self.get_target_state(target_ids[0])
+            return {target_ids[0]: state} if state else {}
+
+        try:
+            pipe = self.redis.pipeline()
+            for tid in target_ids:
+                pipe.hmget(self._make_target_key(tid), _STATE_READ_FIELDS)
+
+            result = {}
+            for tid, raw in zip(target_ids, pipe.execute()):
+                data = self._decode_state_fields(raw)
+                if data:
+                    state = self._dict_to_state(data)
+                    if state:
+                        result[tid] = state
+            return result
+        except Exception as e:
+            logger.error(f"批量获取目标状态失败 [{len(target_ids)}个目标]: {e}")
+            return {}
 
     def delete_target(self, target_id: str, reason: str = "EXPIRED") -> bool:
         """删除目标缓存（发送删除事件）"""
-        try:
-            key = self._make_target_key(target_id)
-            version_key = self._make_version_key(target_id)
+        return self.delete_targets_batch([target_id], reason) == 1
+
+    def delete_targets_batch(self, target_ids: List[str], reason: str = "EXPIRED") -> int:
+        """
+        批量删除目标缓存（删除事件与数据删除同一管道发送，一次往返）
 
-            # 发送删除事件
-            version = self.get_target_version(target_id)
-            self._emit_delta_event(target_id, version, {}, "DELETE", reason)
+        删除事件的版本号取当前毫秒时间戳，晚于目标最后一次更新，
+        按版本拉取增量的客户端可以收到该事件
 
-            # 删除数据
-            self.redis.delete(key, version_key)
+        Returns:
+            删除的目标数量
+        """
+        if not target_ids:
+            return 0
+
+        try:
+            version = time.time_ns() // 1_000_000
+
+            pipe = self.redis.pipeline()
+            for target_id in target_ids:
+                # 发送删除事件
+                self._queue_delta_event(pipe, target_id, version, {}, "DELETE", reason)
+
+                # 删除数据
+                keys = self._keys_for(target_id)
+                pipe.delete(keys.state, keys.version)
+            pipe.zrem(self.live_targets_key, *target_ids)
+            pipe.execute()
 
-            return True
+            return len(target_ids)
         except Exception as e:
-            logger.error(f"删除目标缓存失败 [{target_id}]: {e}")
-            return False
+            logger.error(f"删除目标缓存失败 [{len(target_ids)}个目标]: {e}")
+            return 0
 
     def _compute_delta(self, old_data: Dict, new_data: Dict) -> Optional[Dict]:
         """计算两个状态之间的增量"""
         delta = {}
 
-        # 对比位置变化
-        old_pos = old_data.get("position", {})
-        new_pos = new_data.get("position", {})
+        # 对比位置变化（按阈值数值比较）
+        old_lon, old_lat, old_alt = self._position_of(old_data)
+        new_lon, new_lat, new_alt = self._position_of(new_data)
+        d_lon = new_lon - old_lon
+        d_lat = new_lat - old_lat
+        d_alt = new_alt - old_alt
 
-        if old_pos != new_pos:
+        if abs(d_lon) > _LONLAT_EPS or abs(d_lat) > _LONLAT_EPS or abs(d_alt) > _ALT_EPS:
             delta["position"] = {
-                "from": old_pos,
-                "to": new_pos,
+                "from": {"longitude": old_lon, "latitude": old_lat, "altitude": old_alt},
+                "to": {"longitude": new_lon, "latitude": new_lat, "altitude": new_alt},
                 "delta": {
-                    "d_lon": new_pos["longitude"] - old_pos["longitude"],
-                    "d_lat": new_pos["latitude"] - old_pos["latitude"],
-                    "d_alt": new_pos["altitude"] - old_pos["altitude"]
+                    "d_lon": d_lon,
+                    "d_lat": d_lat,
+                    "d_alt": d_alt
                 }
             }
 
         # 对比航向变化
-        if old_data.get("heading") != new_data.get("heading"):
-            old_h = old_data.get("heading", 0)
-            new_h = new_data.get("heading", 0)
-            diff = (new_h - old_h + 180) % 360 - 180  # 处理0/360环绕
+        old_h = old_data.get("heading", 0)
+        new_h = new_data.get("heading", 0)
+        diff = (new_h - old_h + 180) % 360 - 180  # 处理0/360环绕
 
+        if abs(diff) > _MOTION_EPS:
             delta["heading"] = {
                 "from": old_h,
                 "to": new_h,
@@ -204,61 +507,119 @@ class TargetCache:
             }
 
         # 对比速度变化
-        if old_data.get("speed") != new_data.get("speed"):
+        old_speed = old_data.get("speed", 0)
+        new_speed = new_data.get("speed", 0)
+
+        if abs(new_speed - old_speed) > _MOTION_EPS:
             delta["speed"] = {
-                "from": old_data.get("speed"),
-                "to": new_data.get("speed"),
-                "delta": new_data.get("speed") - old_data.get("speed")
+                "from": old_speed,
+                "to": new_speed,
+                "delta": new_speed - old_speed
             }
 
         # 添加时间戳
         if delta:
-            delta["_changed_at"] = new_data.get("timestamp")
+            delta["_changed_at"] = self._timestamp_of(new_data).isoformat()
             delta["_fields"] = list(delta.keys())
 
         return delta if delta else None
 
-    def _emit_delta_event(self, target_id: str, version: int, delta: Dict,
-                          event_type: str, reason: str = None):
-        """发送增量事件到Redis Stream"""
-        try:
-            stream_key = self._make_delta_stream_key(target_id)
+    def _build_delta_event(self, target_id: str, version: int, delta: Dict,
+                           event_type: str, reason: str = None) -> Dict[str, Any]:
+        """构建增量事件"""
+        event = {
+            "target_id": target_id,
+            "version": version,
+            "event_type": event_type,  # UPDATE/DELETE
+            "timestamp": datetime.now().isoformat(),
+            "delta": delta
+        }
 
-            event = {
-                "target_id": target_id,
-                "version": version,
-                "event_type": event_type,  # UPDATE/DELETE
-                "timestamp": datetime.now().isoformat(),
-                "delta": delta
-            }
+        if reason:
+            event["reason"] = reason
 
-            if reason:
-                event["reason"] = reason
+        return event
 
-            # 使用Stream，保留最近7天的数据
-            self.redis.xadd(
-                stream_key,
-                event,
-                maxlen=10000  # 限制单目标最大事件数
-            )
+    def _delta_entry_id(self, version: int) -> str:
+        """
+        增量事件的Stream消息ID
 
-            # 设置Stream过期时间（7天）
-            self.redis.expire(stream_key, RedisConfig.DELTA_STREAM_TTL)
+        版本号即毫秒时间戳，直接作为消息ID的毫秒部分（序号由Redis自动分配，需Redis 7+），
+        按版本查询时可用XRANGE直接定位起点；版本不大于流中最后的ID时（多进程时钟偏差、
+        并发写入）由脚本改用Redis分配的ID，事件内的 version 字段仍为原版本
+        """
+        return f"{version}-*" if version else "*"
 
-            logger.debug(f"发送增量事件 [{target_id}]: {event_type}")
+    def _should_refresh_delta_ttl(self, target_id: str) -> bool:
+        """
+        是否需要刷新增量流TTL
 
-        except Exception as e:
-            logger.error(f"发送增量事件失败 [{target_id}]: {e}")
+        本进程内首次写入及之后至多每 DELTA_STREAM_EXPIRE_INTERVAL 秒刷新一次，
+        保证新建的流一定带有过期时间
+        """
+        now = time.monotonic()
+        interval = RedisConfig.DELTA_STREAM_EXPIRE_INTERVAL
+        if now - self._delta_ttl_refreshed.get(target_id, -interval) < interval:
+            return False
+
+        if len(self._delta_ttl_refreshed) >= RedisConfig.DELTA_STREAM_EXPIRE_TRACKED:
+            # 清理已超过刷新间隔的记录（这些流下次写入时本就需要刷新）
+            self._delta_ttl_refreshed = {
+                tid: ts for tid, ts in self._delta_ttl_refreshed.items() if now - ts < interval
+            }
+
+        self._delta_ttl_refreshed[target_id] = now
+        return True
+
+    def _queue_delta_event(self, pipe, target_id: str, version: int, delta: Dict,
+                           event_type: str, reason: str = None):
+        """将增量事件写入命令加入管道"""
+        stream_key = self._keys_for(target_id).delta
+        event = self._build_delta_event(target_id, version, delta, event_type, reason)
+
+        # 整个事件序列化为单个字段（JSON兼容类型走orjson快速路径）
+        self._delta_append_script(
+            keys=[stream_key],
+            args=[
+                self._delta_entry_id(version),
+                RedisConfig.DELTA_STREAM_MAXLEN,  # 限制单目标最大事件数
+                _DELTA_PAYLOAD_FIELD,
+                self.redis._serialize_fast(event),
+                int(self._should_refresh_delta_ttl(target_id)),
+                RedisConfig.DELTA_STREAM_TTL,
+            ],
+            client=pipe
+        )
 
     # ==================== 增量查询接口 ====================
 
-    def get_delta_since(self, target_id: str, since_version: int) -> List[Dict]:
+    def _decode_delta_messages(self, messages: List[Tuple[bytes, Dict[bytes, bytes]]]) -> List[Dict]:
+        """
+        反序列化增量流消息（消息ID附加为 _msg_id）
+
+        连接未开启 decode_responses，消息ID与字段名均为bytes，无需逐个类型判断；
+        旧版按字段分别存储的消息逐字段反序列化
         """
-        获取指定版本之后的所有增量事件
+        deserialize = self.redis._deserialize
+        decode_fields = self.redis._deserialize_hash
+        payload_field = _DELTA_PAYLOAD_FIELD.encode()
+        events = []
+        for msg_id, fields in messages:
+            payload = fields.get(payload_field)
+            event = deserialize(payload) if payload is not None else decode_fields(fields)
+            event["_msg_id"] = msg_id.decode()
+            events.append(event)
+        return events
+
+    def get_delta_since(self, target_id: str, since_version: int,
+                        limit: Optional[int] = None) -> List[Dict]:
+        """
+        获取指定版本之后的增量事件
 
         Args:
             target_id: 目标ID
             since_version: 起始版本（不包含）
+            limit: 最多返回数量（由XRANGE COUNT在Redis端截取，None表示全部）
 
         Returns:
             增量事件列表
@@ -266,22 +627,10 @@ class TargetCache:
         try:
             stream_key = self._make_delta_stream_key(target_id)
 
-            # 读取所有消息
-            messages = self.redis.xrange(stream_key)
-
-            events = []
-            for msg_id, fields in messages:
-                # 反序列化
-                event = {k.decode() if isinstance(k, bytes) else k:
-                             self.redis._deserialize(v)
-                         for k, v in fields.items()}
+            # 消息ID与版本号对齐，从 since_version 之后直接定位读取（无需再按版本过滤）
+            messages = self.redis.xrange(stream_key, f"{since_version + 1}-0", count=limit)
 
-                # 检查版本
-                if event.get("version", 0) > since_version:
-                    event["_msg_id"] = msg_id.decode() if isinstance(msg_id, bytes) else msg_id
-                    events.append(event)
-
-            return events
+            return self._decode_delta_messages(messages)
 
         except Exception as e:
             logger.error(f"获取增量失败 [{target_id}]: {e}")
@@ -299,52 +648,78 @@ class TargetCache:
 
             messages = self.redis.xrange(stream_key, start_id, end_id)
 
-            events = []
-            for msg_id, fields in messages:
-                event = {k.decode() if isinstance(k, bytes) else k:
-                             self.redis._deserialize(v)
-                         for k, v in fields.items()}
-                event["_msg_id"] = msg_id.decode() if isinstance(msg_id, bytes) else msg_id
-                events.append(event)
-
-            return events
+            return self._decode_delta_messages(messages)
 
         except Exception as e:
             logger.error(f"获取范围增量失败 [{target_id}]: {e}")
             return []
 
+    def count_active_targets(self) -> int:
+        """统计活跃目标数（ZCOUNT在Redis端计数，不传输目标ID列表）"""
+        try:
+            return self.redis.client.zcount(self.live_targets_key, time.time(), "+inf")
+        except Exception as e:
+            logger.error(f"统计活跃目标失败: {e}")
+            return 0
+
     def get_all_active_targets(self) -> List[str]:
-        """获取所有活跃的目标ID"""
+        """获取所有活跃的目标ID（读取存活目标索引中未过期的成员，一次往返）"""
         try:
-            # 扫描所有目标key
-            pattern = self.redis._make_key("target", "*")
-            keys = []
-            cursor = 0
-
-            while True:
-                cursor, partial_keys = self.redis.client.scan(
-                    cursor=cursor,
-                    match=pattern,
-                    count=100
-                )
-                keys.extend([k.decode() if isinstance(k, bytes) else k for k in partial_keys])
-
-                if cursor == 0:
-                    break
-
-            # 提取target_id
-            target_ids = []
-            for key in keys:
-                parts = key.split(":")
-                if len(parts) >= 3 and parts[-1] != "version":
-                    target_ids.append(parts[-2])
-
-            return list(set(target_ids))
+            target_ids = self.redis.client.zrangebyscore(self.live_targets_key, time.time(), "+inf")
+            return [tid.decode() if isinstance(tid, bytes) else tid for tid in target_ids]
 
         except Exception as e:
             logger.error(f"获取活跃目标失败: {e}")
             return []
 
 
+# 追加增量事件（近似裁剪）；指定的消息ID不大于流中最后的ID时XADD报错，改由Redis分配ID
+_DELTA_APPEND_LUA = """
+local function append_delta(key, id, maxlen, field, payload)
+    local reply = redis.pcall('XADD', key, 'MAXLEN', '~', maxlen, id, field, payload)
+    if type(reply) == 'table' and reply.err then
+        redis.call('XADD', key, 'MAXLEN', '~', maxlen, '*', field, payload)
+    end
+end
+"""
+
+# 状态条件写入：KEYS=[状态key, 版本key, 存活索引key, 增量流key]
+# ARGV=[期望的旧指纹原始值(空串表示不存在), TTL, 版本, 目标ID, 存活索引score,
+#       增量事件(空串表示无), 流消息ID, 流最大长度, 是否刷新流TTL, 流TTL, 事件字段名, 字段数N, 字段1, 值1, ...]
+# Redis端当前指纹与期望值不一致时不写入，返回0
+_STATE_WRITE_SCRIPT = _DELTA_APPEND_LUA + """
+local current = redis.call('HGET', KEYS[1], '_hash')
+if (current or '') ~= ARGV[1] then
+    return 0
+end
+
+-- 先追加增量事件：脚本出错不会回滚已执行的写入，事件写入失败时状态保持不变
+if ARGV[6] ~= '' then
+    append_delta(KEYS[4], ARGV[7], ARGV[8], ARGV[11], ARGV[6])
+    if ARGV[9] == '1' then
+        redis.call('EXPIRE', KEYS[4], ARGV[10])
+    end
+end
+
+local n = tonumber(ARGV[12])
+if n > 0 then
+    redis.call('HSET', KEYS[1], unpack(ARGV, 13, 12 + 2 * n))
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('SET', KEYS[2], ARGV[3], 'EX', ARGV[2])
+redis.call('ZADD', KEYS[3], ARGV[5], ARGV[4])
+return 1
+"""
+
+# 单独追加增量事件（删除事件等）：KEYS=[增量流key]
+# ARGV=[流消息ID, 流最大长度, 事件字段名, 增量事件, 是否刷新流TTL, 流TTL]
+_DELTA_APPEND_SCRIPT = _DELTA_APPEND_LUA + """
+append_delta(KEYS[1], ARGV[1], ARGV[2], ARGV[3], ARGV[4])
+if ARGV[5] == '1' then
+    redis.call('EXPIRE', KEYS[1], ARGV[6])
+end
+return 1
+"""
+
 # 全局TargetCache实例
 target_cache = TargetCache()
\ No newline at end of file
@@ -103,6 +103,62 @@ class FormationRecognitionEngine:
         self.processing_stats['valid_tracks'] = len(self.tracks)
         return self
 
+    def process_columns(self, columns: Dict[str, np.ndarray]) -> 'FormationRecognitionEngine':
+        """
+        处理列式输入数据（见 api_models.to_soa）
+
+        时间列整体解析一次，数值列整列转换，避免逐条记录的字典查找和时间解析
+        """
+        self.tracks.clear()
+        self.processing_stats['total_targets'] = 0
+
+        try:
+            timestamps = list(pd.to_datetime(columns['time']))
+        except Exception:
+            # 时区不一致等情况逐条解析
+            timestamps = [pd.to_datetime(t) for t in columns['time']]
+
+        lons = columns['lon'].tolist()
+        lats = columns['lat'].tolist()
+        alts = columns['alt'].tolist()
+        headings = columns['heading'].tolist()
+        speeds = columns['speed'].tolist()
+
+        for i, tid in enumerate(columns['id']):
+            if not tid:
+                continue
+
+            if tid not in self.tracks:
+                try:
+                    platform_type = PlatformType(columns['type'][i])
+                except:
+                    platform_type = PlatformType.UNKNOWN
+
+                attrs = TargetAttributes(
+                    target_type=platform_type,
+                    nation=columns['nation'][i],
+                    alliance=columns['alliance'][i],
+                    theater=columns['theater'][i],
+                    airport=columns['airport'][i]
+                )
+                self.tracks[tid] = TargetTrack(tid, columns['name'][i] or tid, attrs)
+                self.processing_stats['total_targets'] += 1
+
+            state = TargetState(
+                timestamp=timestamps[i],
+                position=GeoPosition(lons[i], lats[i], alts[i]),
+                heading=headings[i],
+                speed=speeds[i]
+            )
+            self.tracks[tid].add_state(state)
+
+        # 完成所有航迹
+        for track in self.tracks.values():
+            track.finalize()
+
+        self.processing_stats['valid_tracks'] = len(self.tracks)
+        return self
+
     def _process_single_record(self, record: Dict):
         """处理单条记录"""
         tid = record.get('id')
@@ -149,10 +205,12 @@ class FormationRecognitionEngine:
         )
         self.tracks[tid].add_state(state)
 
-    def recognize(self, time_range: Optional[Tuple[datetime, datetime]] = None) -> List[Formation]:
+    def recognize(self, time_range: Optional[Tuple[Any, Any]] = None) -> List[Formation]:
         """
         执行编队识别（主算法）
 
+        time_range 两端可为 datetime、epoch秒或None（None取数据边界）
+
         流程：
         1. 确定分析时间范围
         2. 多时间点采样和规则评估
@@ -165,19 +223,27 @@ class FormationRecognitionEngine:
             return []
 
         # 步骤1: 确定时间范围
-        if time_range is None:
-            all_times = []
-            for track in self.tracks.values():
-                for seg in track.segments:
-                    all_times.extend([s.timestamp for s in seg])
+        start_time, end_time = time_range if time_range else (None, None)
+
+        all_times = []
+        for track in self.tracks.values():
+            for seg in track.segments:
+                all_times.extend([s.timestamp for s in seg])
 
+        if start_time is None or end_time is None:
             if len(all_times) < 2:
                 print("警告: 时间数据不足")
                 return []
 
-            start_time, end_time = min(all_times), max(all_times)
-        else:
-            start_time, end_time = time_range
+            if start_time is None:
+                start_time = min(all_times)
+            if end_time is None:
+                end_time = max(all_times)
+
+        # epoch秒按航迹时间的时区转换（航迹为naive时按本地时间）
+        tz_aware = bool(all_times) and all_times[0].tzinfo is not None
+        start_time = self._to_track_time(start_time, tz_aware)
+        end_time = self._to_track_time(end_time, tz_aware)
 
         print(f"\n{'=' * 70}")
         print("编队识别开始")
@@ -279,6 +345,15 @@ class FormationRecognitionEngine:
         print(f"\n识别完成: {len(self.formations)}个编队")
         return self.formations
 
+    @staticmethod
+    def _to_track_time(value: Any, tz_aware: bool) -> datetime:
+        """epoch秒转换为与航迹一致的时间，datetime原样返回"""
+        if isinstance(value, (int, float)):
+            if tz_aware:
+                return pd.Timestamp(value, unit='s', tz='UTC')
+            return datetime.fromtimestamp(value)
+        return value
+
     def _build_formations(self, valid_pairs: List[Dict],
                           start_time: datetime, end_time: datetime) -> List[Dict]:
         """基于图连通性构建编队"""
@@ -6,12 +6,16 @@ import time
 import json
 import logging
 import asyncio
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Optional, Tuple, Union
 from datetime import datetime
 from copy import deepcopy
 
+import numpy as np
+import pandas as pd
+
 from formation_engine import FormationRecognitionEngine
 from formation_engine_smart import SmartFormationEngine
+from models import Formation, TargetState, GeoPosition
 from rule_manager import RuleManager
 from rules import RuleContext, RuleResult, RulePriority
 from cache.target_cache import target_cache
@@ -44,6 +48,14 @@ class FormationService:
             'delta_events_sent': 0
         }
 
+        # 增量引擎为共享实例，异步识别时串行访问
+        self._smart_engine_lock = asyncio.Lock()
+
+        # 纯缓存写入合并：短时间内的多个请求合并为一次管道写入
+        self.cache_write_flush_interval = 0.01  # 秒
+        self._cache_write_queue: Optional[asyncio.Queue] = None
+        self._cache_write_task: Optional[asyncio.Task] = None
+
     def initialize(self):
         """初始化服务"""
         logger.info("初始化编队识别服务（集成Redis缓存）")
@@ -82,10 +94,10 @@ class FormationService:
     # ==================== 核心识别接口 ====================
 
     def recognize(self,
-                  targets: List[Dict],
+                  targets: Union[List[Dict], Dict[str, np.ndarray]],
                   preset: Optional[str] = None,
                   scene_type: Optional[str] = None,
-                  time_range: Optional[Dict] = None,
+                  time_range: Optional[Tuple[Optional[int], Optional[int]]] = None,
                   use_cache: bool = True,
                   incremental: bool = False,
                   emit_events: bool = True) -> Dict[str, Any]:
@@ -93,10 +105,10 @@ class FormationService:
         执行编队识别（集成缓存）
 
         Args:
-            targets: 目标数据列表
+            targets: 目标数据列表，或列式结构（api_models.to_soa，仅全量模式）
             preset: 规则预设名称
             scene_type: 场景类型
-            time_range: 时间范围
+            time_range: 时间范围 (开始, 结束)，epoch秒，任一端可为None
             use_cache: 是否使用Redis缓存
             incremental: 是否使用增量识别（只处理变化的目标）
             emit_events: 是否发送WebSocket事件
@@ -120,22 +132,23 @@ class FormationService:
         else:
             engine.load_preset("tight_fighter")
 
-        # 处理时间范围
-        tr = None
-        if time_range:
-            tr = (
-                datetime.fromisoformat(time_range['start']) if time_range.get('start') else None,
-                datetime.fromisoformat(time_range['end']) if time_range.get('end') else None
-            )
+        # 时间范围直接交给引擎（epoch秒在引擎内按航迹时区转换一次）
+        tr = time_range if time_range and any(t is not None for t in time_range) else None
 
         # 执行识别
-        if incremental:
+        columnar = isinstance(targets, dict)
+        target_ids = targets['id'] if columnar else [t.get('id') for t in targets]
+        if incremental and not columnar:
             # 增量模式
             formations = engine.process_data_with_cache(targets).recognize_incremental(tr)
         else:
             # 全量模式
-            formations = engine.process_data(targets).recognize(tr)
-            formations = [f.to_dict() for f in formations]
+            if columnar:
+                engine.process_columns(targets)
+            else:
+                engine.process_data(targets)
+            formations = [f.to_dict() for f in engine.recognize(tr)]
+            incremental = False
 
         # 存储编队结果到Redis（7天滚动）
         stored_ids = []
@@ -168,8 +181,8 @@ class FormationService:
             "incremental": incremental,
             "metadata": {
                 "preset_used": preset or scene_type or "tight_fighter",
-                "target_count": len(targets),
-                "unique_targets": len(set(t.get('id') for t in targets)),
+                "target_count": len(target_ids),
+                "unique_targets": len(set(target_ids)),
                 "timestamp": datetime.now().isoformat()
             }
         }
@@ -182,31 +195,55 @@ class FormationService:
 
         return result
 
+    async def arecognize(self,
+                         targets: Union[List[Dict], Dict[str, np.ndarray]],
+                         preset: Optional[str] = None,
+                         scene_type: Optional[str] = None,
+                         time_range: Optional[Tuple[Optional[int], Optional[int]]] = None,
+                         use_cache: bool = True,
+                         incremental: bool = False,
+                         emit_events: bool = True) -> Dict[str, Any]:
+        """
+        执行编队识别（异步版本）
+
+        识别计算和Redis读写在线程池中执行，不阻塞事件循环；
+        WebSocket事件回到事件循环中发送
+        """
+        args = (targets, preset, scene_type, time_range, use_cache, incremental, False)
+
+        if incremental and self.smart_engine:
+            async with self._smart_engine_lock:
+                result = await asyncio.to_thread(self.recognize, *args)
+        else:
+            result = await asyncio.to_thread(self.recognize, *args)
+
+        if emit_events and result["formations"]:
+            self._emit_formation_events(result["formations"])
+
+        return result
+
     def _emit_formation_events(self, formations: List[Dict]):
         """发送编队识别事件（异步）"""
         try:
-            loop = asyncio.get_event_loop()
             for formation_dict in formations:
-                loop.create_task(
-                    websocket_manager.notify_formation_detected(formation_dict)
-                )
+                websocket_manager.emit_formation_detected(formation_dict)
             self.cache_stats['delta_events_sent'] += len(formations)
         except Exception as e:
             logger.warning(f"发送编队事件失败: {e}")
 
     def _dict_to_formation(self, data: Dict) -> 'Formation':
         """字典转换为Formation对象"""
-        from models import Formation, GeoPosition
 
         center = data.get("spatial", {}).get("center", {})
+        now = datetime.now()
 
         return Formation(
             formation_id=data.get("formation_id", 0),
             formation_type=data.get("formation_type", "Unknown"),
             confidence=data.get("confidence", 0),
             members={},  # 简化
-            time_range=(datetime.now(), datetime.now()),
-            create_time=datetime.now(),
+            time_range=(now, now),
+            create_time=now,
             center_position=GeoPosition(
                 longitude=center.get("longitude", 0),
                 latitude=center.get("latitude", 0),
@@ -226,68 +263,186 @@ class FormationService:
 
     # ==================== 纯缓存接口（不触发识别） ====================
 
-    def cache_targets_only(self, targets: List[Dict]) -> Dict[str, Any]:
+    def cache_targets_only(self, targets: List[Dict],
+                           emit_events: bool = True) -> Dict[str, Any]:
         """
         仅缓存目标状态，不执行编队识别
 
         用于外部系统批量同步数据到缓存
         """
-        updated = []
-        failed = []
+        result, deltas = self._cache_targets(targets)
+
+        if emit_events:
+            self._emit_target_events(deltas)
+
+        return result
 
-        for target_data in targets:
-            tid = target_data.get('id')
-            if not tid:
-                failed.append({"error": "缺少ID"})
-                continue
+    async def acache_targets_only(self, targets: List[Dict],
+                                  emit_events: bool = True) -> Dict[str, Any]:
+        """
+        仅缓存目标状态（异步版本，Redis写入在线程池中执行）
 
+        合并写入任务运行时，请求进入队列，与同一时间窗口内的其他请求合并写入
+        """
+        if self.cache_write_flusher_running:
+            future = asyncio.get_running_loop().create_future()
+            await self._cache_write_queue.put((targets, future))
+            result, deltas = await future
+        else:
+            result, deltas = await asyncio.to_thread(self._cache_targets, targets)
+
+        if emit_events:
+            self._emit_target_events(deltas)
+
+        return result
+
+    @property
+    def cache_write_flusher_running(self) -> bool:
+        """合并写入任务是否运行"""
+        return self._cache_write_task is not None and not self._cache_write_task.done()
+
+    def start_cache_write_flusher(self):
+        """启动纯缓存写入合并任务（需在事件循环中调用）"""
+        if self.cache_write_flusher_running:
+            return
+        self._cache_write_queue = asyncio.Queue()
+        self._cache_write_task = asyncio.create_task(self._cache_write_flush_loop())
+        logger.info(f"缓存写入合并已启动，窗口{self.cache_write_flush_interval * 1000:.0f}ms")
+
+    async def stop_cache_write_flusher(self):
+        """停止纯缓存写入合并任务，并写入队列中剩余请求"""
+        if self._cache_write_task is None:
+            return
+        self._cache_write_task.cancel()
+        try:
+            await self._cache_write_task
+        except asyncio.CancelledError:
+            pass
+        self._cache_write_task = None
+        await self._flush_cache_writes(self._drain_cache_write_queue())
+
+    def _drain_cache_write_queue(self) -> List[Tuple[List[Dict], asyncio.Future]]:
+        pending = []
+        while not self._cache_write_queue.empty():
+            pending.append(self._cache_write_queue.get_nowait())
+        return pending
+
+    async def _cache_write_flush_loop(self):
+        """合并写入循环：收到首个请求后等待一个窗口，再把队列中的请求一次写入"""
+        while True:
+            first = await self._cache_write_queue.get()
             try:
+                await asyncio.sleep(self.cache_write_flush_interval)
+            except asyncio.CancelledError:
+                # 放回队列，由停止时统一写入
+                self._cache_write_queue.put_nowait(first)
+                raise
+
+            # 写入过程中即使任务被取消，也要把结果返回给等待方
+            await asyncio.shield(
+                self._flush_cache_writes([first] + self._drain_cache_write_queue())
+            )
+
+    async def _flush_cache_writes(self, pending: List[Tuple[List[Dict], asyncio.Future]]):
+        """写入一组排队的请求，并把各自的结果返回给等待方"""
+        if not pending:
+            return
+
+        try:
+            results = await asyncio.to_thread(
+                self._cache_target_batches, [targets for targets, _ in pending]
+            )
+        except Exception as e:
+            logger.error(f"合并缓存写入失败: {e}")
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(pending, results):
+            if not future.done():
+                future.set_result(result)
+
+    def _cache_targets(self, targets: List[Dict]) -> Tuple[Dict[str, Any], List[Tuple[str, Dict]]]:
+        """
+        写入目标状态缓存
+
+        Returns:
+            (缓存结果, 待推送的增量列表[(target_id, delta)])
+        """
+        return self._cache_target_batches([targets])[0]
+
+    def _cache_target_batches(self, batches: List[List[Dict]]
+                              ) -> List[Tuple[Dict[str, Any], List[Tuple[str, Dict]]]]:
+        """
+        写入多个请求的目标状态缓存（合并为一次管道写入）
+
+        Returns:
+            每个请求各自的 (缓存结果, 待推送的增量列表[(target_id, delta)])
+        """
+        updated = [[] for _ in batches]
+        failed = [[] for _ in batches]
+        deltas = [[] for _ in batches]
+
+        # 先解析全部目标，再通过管道批量写入缓存
+        items = []
+        owners = []
+        for index, targets in enumerate(batches):
+            for target_data in targets:
+                tid = target_data.get('id')
+                if not tid:
+                    failed[index].append({"error": "缺少ID"})
+                    continue
+
                 # 解析为TargetState
                 state = self._parse_target_data(target_data)
                 if not state:
-                    failed.append({"target_id": tid, "error": "数据解析失败"})
+                    failed[index].append({"target_id": tid, "error": "数据解析失败"})
                     continue
 
-                # 更新缓存
-                success, is_update, delta = target_cache.cache_target_state(
-                    tid, state, emit_delta=True
-                )
+                items.append((tid, state))
+                owners.append(index)
 
-                if success:
-                    updated.append({
-                        "target_id": tid,
-                        "version": target_cache.get_target_version(tid),
-                        "is_update": is_update,
-                        "has_delta": delta is not None
-                    })
-
-                    # 发送WebSocket增量事件
-                    if is_update and delta:
-                        try:
-                            loop = asyncio.get_event_loop()
-                            loop.create_task(
-                                websocket_manager.notify_target_update(tid, delta)
-                            )
-                        except Exception as e:
-                            logger.warning(f"发送增量事件失败: {e}")
-                else:
-                    failed.append({"target_id": tid, "error": "缓存写入失败"})
-
-            except Exception as e:
-                failed.append({"target_id": tid, "error": str(e)})
+        results = target_cache.cache_target_states_batch(items, emit_delta=True)
 
-        return {
-            "success": True,
-            "updated": len(updated),
-            "failed": len(failed),
-            "details": {"updated": updated, "failed": failed}
-        }
+        for index, (tid, _), (success, is_update, delta, version) in zip(owners, items, results):
+            if success:
+                updated[index].append({
+                    "target_id": tid,
+                    "version": version,
+                    "is_update": is_update,
+                    "has_delta": delta is not None
+                })
+
+                if is_update and delta:
+                    deltas[index].append((tid, delta))
+            else:
+                failed[index].append({"target_id": tid, "error": "缓存写入失败"})
+
+        return [
+            ({
+                "success": True,
+                "updated": len(updated[index]),
+                "failed": len(failed[index]),
+                "details": {"updated": updated[index], "failed": failed[index]}
+            }, deltas[index])
+            for index in range(len(batches))
+        ]
+
+    def _emit_target_events(self, deltas: List[Tuple[str, Dict]]):
+        """发送WebSocket增量事件（异步）"""
+        if not deltas:
+            return
+
+        try:
+            asyncio.get_event_loop().create_task(
+                websocket_manager.broadcast_targets(deltas)
+            )
+        except Exception as e:
+            logger.warning(f"发送增量事件失败: {e}")
 
     def _parse_target_data(self, data: Dict) -> Optional['TargetState']:
         """解析目标数据为TargetState"""
-        from models import TargetState, GeoPosition
-        import pandas as pd
-
         try:
             timestamp = pd.to_datetime(data.get('时间'))
             pos = data.get('位置', (0, 0, 0))
@@ -626,14 +781,12 @@ class FormationService:
         try:
             if target_ids:
                 # 清理指定目标
-                for tid in target_ids:
-                    target_cache.delete_target(tid, reason="MANUAL_CLEAR")
+                target_cache.delete_targets_batch(target_ids, reason="MANUAL_CLEAR")
                 return {"cleared": len(target_ids), "targets": target_ids}
             else:
                 # 获取所有目标并清理
                 all_targets = target_cache.get_all_active_targets()
-                for tid in all_targets:
-                    target_cache.delete_target(tid, reason="MANUAL_CLEAR_ALL")
+                target_cache.delete_targets_batch(all_targets, reason="MANUAL_CLEAR_ALL")
                 return {"cleared": len(all_targets), "targets": all_targets}
         except Exception as e:
             return {"error": str(e)}
\ No newline at end of file
@@ -11,16 +11,20 @@ from fastapi.openapi.docs import get_swagger_ui_html
 from contextlib import asynccontextmanager
 from typing import List, Dict, Any, Optional
 from datetime import datetime
+import asyncio
 import json
 import logging
 import os
+import sys
 
 # 导入业务模块
 from database import db_manager
 from api_models import (
     TargetData, FormationResult, RecognitionRequest, RecognitionResponse,
-    HealthCheck, ApiResponse
+    HealthCheck, ApiResponse, to_soa, to_epoch_range
 )
+import api_models_fast
+from api_requests import parse_recognition_request, RECOGNITION_OPENAPI
 from formation_service import formation_service
 from api_rules import router as rules_router
 from api_cache import router as cache_router  # 新增缓存路由
@@ -36,12 +40,21 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 优先使用uvloop事件循环（libuv实现，Windows不支持）
+# 在模块导入时安装，gunicorn/uvicorn worker导入应用时同样生效
+if not sys.platform.startswith("win"):
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        logger.warning("uvloop未安装，使用默认asyncio事件循环")
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """应用生命周期管理"""
     # 启动时
-    logger.info("服务启动中...")
+    logger.info("服务启动中... 事件循环: %s", type(asyncio.get_running_loop()).__module__)
 
     # 初始化数据库
     db_manager.init_database()
@@ -55,12 +68,22 @@ async def lifespan(app: FastAPI):
     # 启动定时清理任务
     cleanup_scheduler.start()
 
+    # 启动WebSocket事件总线（多worker共享推送）
+    websocket_manager.start_event_bus()
+    websocket_manager.start_flush_loop()
+
+    # 启动纯缓存写入合并任务
+    formation_service.start_cache_write_flusher()
+
     logger.info("服务启动完成，Redis缓存已启用")
     yield
 
     # 关闭时
     logger.info("服务关闭中...")
     stream_service.shutdown()
+    await formation_service.stop_cache_write_flusher()
+    await websocket_manager.stop_flush_loop()
+    await websocket_manager.stop_event_bus()
     cleanup_scheduler.shutdown()
     formation_service.cleanup()
     logger.info("服务已关闭")
@@ -207,6 +230,11 @@ async def custom_swagger_ui():
 @app.get("/health", tags=["健康检查"], response_model=HealthCheck)
 async def health_check():
     """健康检查"""
+    return await asyncio.to_thread(_build_health_check)
+
+
+def _build_health_check() -> HealthCheck:
+    """构建健康检查结果（涉及Redis/数据库查询，在线程池中执行）"""
     cache_status = formation_service.get_cache_status()
 
     return HealthCheck(
@@ -228,9 +256,11 @@ async def health_check():
 
 @app.post("/recognize",
           tags=["编队识别"],
-          response_model=RecognitionResponse,
-          summary="执行编队识别（集成缓存）")
-async def recognize(request: RecognitionRequest):
+          response_model=None,
+          responses={200: {"model": RecognitionResponse}},
+          summary="执行编队识别（集成缓存）",
+          openapi_extra=RECOGNITION_OPENAPI)
+async def recognize(request: api_models_fast.RecognitionRequest = Depends(parse_recognition_request)):
     """
     执行编队识别（自动缓存目标状态，支持增量识别）
 
@@ -239,23 +269,24 @@ async def recognize(request: RecognitionRequest):
     - 识别结果自动存储7天
     """
     try:
-        logger.info(f"收到识别请求: {len(request.targets)}个目标")
+        logger.info("收到识别请求: %d个目标", len(request.targets))
 
-        # 使用优化后的识别方法
-        result = formation_service.recognize(
-            targets=[t.dict() for t in request.targets],
+        # 使用优化后的识别方法（列式结构传入引擎）
+        result = await formation_service.arecognize(
+            targets=to_soa(request.targets),
             preset=request.preset,
             scene_type=request.scene_type,
-            time_range=request.time_range,
+            time_range=to_epoch_range(request.time_range),
             use_cache=True,  # 启用缓存
             incremental=False,  # 可根据需要改为True
             emit_events=True  # 发送WebSocket事件
         )
 
-        logger.info(f"识别完成: {result['formation_count']}个编队，"
-                    f"已缓存: {result.get('stored_formation_ids', [])}")
+        logger.info("识别完成: %d个编队，已缓存: %s",
+                    result['formation_count'], result.get('stored_formation_ids', []))
 
-        return RecognitionResponse(**result)
+        # 服务层结果直接返回，不再按RecognitionResponse重新校验（模型仅用于文档）
+        return result
 
     except Exception as e:
         logger.error(f"识别失败: {str(e)}")
@@ -264,25 +295,28 @@ async def recognize(request: RecognitionRequest):
 
 @app.post("/recognize/incremental",
           tags=["编队识别"],
-          summary="增量编队识别")
-async def recognize_incremental(request: RecognitionRequest):
+          response_model=None,
+          responses={200: {"model": RecognitionResponse}},
+          summary="增量编队识别",
+          openapi_extra=RECOGNITION_OPENAPI)
+async def recognize_incremental(request: api_models_fast.RecognitionRequest = Depends(parse_recognition_request)):
     """
     增量编队识别（只处理有变化的目标）
 
     适用于高频数据流场景，减少重复计算
     """
     try:
-        result = formation_service.recognize(
-            targets=[t.dict() for t in request.targets],
+        result = await formation_service.arecognize(
+            targets=api_models_fast.to_builtins(request.targets),
             preset=request.preset,
             scene_type=request.scene_type,
-            time_range=request.time_range,
+            time_range=to_epoch_range(request.time_range),
             use_cache=True,
             incremental=True,  # 启用增量模式
             emit_events=True
         )
 
-        return RecognitionResponse(**result)
+        return result
 
     except Exception as e:
         logger.error(f"增量识别失败: {str(e)}")
@@ -301,7 +335,7 @@ async def cache_only(targets: List[Dict] = Body(...)):
     用于外部系统同步数据到缓存，供后续查询或识别使用
     """
     try:
-        result = formation_service.cache_targets_only(targets)
+        result = await formation_service.acache_targets_only(targets)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -330,10 +364,23 @@ app.include_router(stream_router)
 
 # 启动入口
 if __name__ == "__main__":
-    uvicorn.run(
-        "main:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True,
-        log_level="info"
-    )
\ No newline at end of file
+    if os.getenv("ENV") == "dev":
+        # 开发模式：单进程热重载
+        uvicorn.run(
+            "main:app",
+            host="0.0.0.0",
+            port=8000,
+            reload=True,
+            log_level="info"
+        )
+    else:
+        # 生产模式：多进程（WebSocket事件经Redis Stream在各worker间共享，WEB_CONCURRENCY可指定进程数）
+        uvicorn.run(
+            "main:app",
+            host="0.0.0.0",
+            port=8000,
+            workers=int(os.getenv("WEB_CONCURRENCY", 0)) or os.cpu_count(),
+            loop="uvloop",
+            http="httptools",
+            log_level="warning"
+        )
\ No newline at end of file
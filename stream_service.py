@@ -3,7 +3,7 @@
 """
 import asyncio
 import logging
-from typing import Dict, List, Optional, Set
+from typing import Any, Dict, List, Optional, Set
 from datetime import datetime, timedelta
 from collections import deque
 import threading
@@ -102,49 +102,58 @@ class DataStreamService:
         if current_buffer > self.stats['buffer_high_watermark']:
             self.stats['buffer_high_watermark'] = current_buffer
 
-        # 处理每个目标
+        # 解析本批次目标（同一批次共用接收时间）
         changed_targets = []
+        received_at = datetime.now()
 
+        parsed = []
         for target_data in targets:
             tid = target_data.get('id')
             if not tid:
                 continue
 
-            # 解析并缓存
             state = self._parse_to_state(target_data)
             if not state:
                 continue
 
-            # 更新 Redis 缓存
-            try:
-                success, is_update, delta = target_cache.cache_target_state(
-                    tid, state, emit_delta=True
-                )
-
-                if success:
-                    # 加入缓冲区
-                    self.buffer.append({
-                        'target_id': tid,
-                        'data': target_data,
-                        'state': state,
-                        'received_at': datetime.now(),
-                        'source': source,
-                        'is_update': is_update,
-                        'delta': delta
-                    })
-
-                    # 记录变化
-                    if is_update:
-                        changed_targets.append(tid)
-                        with self._lock:
-                            self.pending_targets.add(tid)
-
-                    # 实时推送增量（可选）
-                    if is_update and delta:
-                        await self._notify_delta(tid, delta)
+            parsed.append((tid, target_data, state))
 
-            except Exception as e:
-                logger.error(f"处理目标失败 [{tid}]: {e}")
+        # 整批写入 Redis 缓存（一次读管道 + 一次写管道，增量事件随状态一并写入），
+        # 在线程中执行，Redis往返不阻塞事件循环
+        try:
+            results = await asyncio.to_thread(
+                target_cache.cache_target_states_batch,
+                [(tid, state) for tid, _, state in parsed],
+                True
+            )
+        except Exception as e:
+            logger.error(f"批量缓存目标失败 [{len(parsed)}个目标]: {e}")
+            results = []
+
+        for (tid, target_data, state), (success, is_update, delta, _) in zip(parsed, results):
+            if not success:
+                continue
+
+            # 加入缓冲区
+            self.buffer.append({
+                'target_id': tid,
+                'data': target_data,
+                'state': state,
+                'received_at': received_at,
+                'source': source,
+                'is_update': is_update,
+                'delta': delta
+            })
+
+            # 记录变化
+            if is_update:
+                changed_targets.append(tid)
+                with self._lock:
+                    self.pending_targets.add(tid)
+
+            # 实时推送增量（可选）
+            if is_update and delta:
+                await self._notify_delta(tid, delta)
 
         # 检查是否触发识别
         should_recognize = self._should_trigger_recognize(len(changed_targets), received_count)
@@ -313,9 +322,9 @@ class DataStreamService:
             "engine_status": self.engine.get_cache_status() if self.engine else None
         }
 
-    def get_recent_formations(self, count: int = 10) -> List[Dict]:
-        """获取最近识别的编队"""
-        return formation_store.get_latest_formations(count)
+    def get_recent_formations(self, count: int = 10, include_tracks: bool = True) -> List[Dict]:
+        """获取最近识别的编队（include_tracks=False 时不读取完整航迹）"""
+        return formation_store.get_latest_formations(count, include_tracks=include_tracks)
 
     def force_recognize(self) -> Dict[str, Any]:
         """强制立即执行识别"""
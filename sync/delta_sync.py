@@ -36,11 +36,12 @@ class DeltaSyncService:
         import uuid
         session_id = f"sync_{client_id}_{uuid.uuid4().hex[:8]}"
 
+        now = datetime.now().isoformat()
         session_data = {
             "session_id": session_id,
             "client_id": client_id,
-            "created_at": datetime.now().isoformat(),
-            "last_sync_at": datetime.now().isoformat(),
+            "created_at": now,
+            "last_sync_at": now,
             "target_ids": target_ids or [],  # 空列表表示订阅全部
             "versions": {},  # 每个目标的最后同步版本
             "is_active": True
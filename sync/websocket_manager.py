@@ -1,18 +1,54 @@
 """
 WebSocket管理器 - 实时推送增量更新
 """
+import os
 import json
+import asyncio
 import logging
-from typing import Dict, Set, Optional, List
+from typing import Any, Dict, Set, Optional, List, Iterable, Tuple, Union
 from datetime import datetime
 
+import msgpack
+import numpy as np
+import orjson
 from fastapi import WebSocket, WebSocketDisconnect
 
+from cache.redis_client import redis_client, RedisConfig
 from cache.target_cache import target_cache
 from sync.delta_sync import delta_sync
 
 logger = logging.getLogger(__name__)
 
+_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+# 释放目标订阅：进程计数减1，归零时删除字段（原子执行，避免并发订阅时误删）
+_RELEASE_SUBSCRIPTIONS_SCRIPT = """
+for i = 1, #ARGV do
+    if redis.call('HINCRBY', KEYS[1], ARGV[i], -1) <= 0 then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+    end
+end
+return #ARGV
+"""
+
+
+def _msgpack_default(obj: Any) -> Any:
+    """msgpack编码特殊类型（与JSON帧的表示保持一致）"""
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, set):
+        return list(obj)
+    raise TypeError(f"无法序列化类型: {type(obj)}")
+
+
+def _pack(message: dict) -> bytes:
+    """编码msgpack二进制帧"""
+    return msgpack.packb(message, default=_msgpack_default)
+
 
 class ConnectionManager:
     """WebSocket连接管理"""
@@ -21,12 +57,28 @@ class ConnectionManager:
         # {client_id: WebSocket}
         self.active_connections: Dict[str, WebSocket] = {}
 
-        # {target_id: Set[client_id]} - 目标订阅关系
+        # {target_id: Set[client_id]} - 目标订阅关系（按目标分房间，无订阅者时移除）
         self.target_subscriptions: Dict[str, Set[str]] = {}
 
         # {client_id: Set[target_id]} - 反向索引
         self.client_subscriptions: Dict[str, Set[str]] = {}
 
+        # 使用msgpack二进制帧通信的连接（收到其msgpack消息后切换，其余连接使用JSON文本帧）
+        self.binary_clients: Set[str] = set()
+
+        # 跨进程事件总线（Redis Stream），未启动时退化为进程内直接推送
+        self.event_stream = redis_client._make_key(RedisConfig.EVENT_STREAM)
+        self._event_bus_task: Optional[asyncio.Task] = None
+
+        # 集群订阅表（Hash {target_id: 进程数}），本进程房间创建/清空时增减计数
+        self.subscription_key = redis_client._make_key(RedisConfig.WS_SUBSCRIPTIONS)
+        self._release_script_obj = None
+
+        # 事件合并推送：按间隔累积事件后合并为一帧（WS_FLUSH_MS=0 关闭）
+        self.flush_interval = int(os.getenv("WS_FLUSH_MS", "500")) / 1000
+        self._pending: List[Tuple[str, dict]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+
     async def connect(self, websocket: WebSocket, client_id: str) -> bool:
         """建立连接"""
         try:
@@ -44,14 +96,22 @@ class ConnectionManager:
         """断开连接"""
         # 清理订阅关系
         if client_id in self.client_subscriptions:
-            for target_id in self.client_subscriptions[client_id]:
-                if target_id in self.target_subscriptions:
-                    self.target_subscriptions[target_id].discard(client_id)
+            emptied = [
+                target_id for target_id in self.client_subscriptions[client_id]
+                if self._leave_room(target_id, client_id)
+            ]
             del self.client_subscriptions[client_id]
 
+            # 同步调用，集群订阅表在后台更新
+            if emptied and self.event_bus_running:
+                asyncio.get_event_loop().create_task(
+                    asyncio.to_thread(self._release_targets, emptied)
+                )
+
         # 移除连接
         if client_id in self.active_connections:
             del self.active_connections[client_id]
+        self.binary_clients.discard(client_id)
 
         logger.info(f"WebSocket连接断开 [{client_id}]")
 
@@ -60,12 +120,18 @@ class ConnectionManager:
         if client_id not in self.active_connections:
             return
 
+        created = []
         for tid in target_ids:
             if tid not in self.target_subscriptions:
                 self.target_subscriptions[tid] = set()
+                created.append(tid)
             self.target_subscriptions[tid].add(client_id)
             self.client_subscriptions[client_id].add(tid)
 
+        # 确认前写入集群订阅表，确认后其他进程的更新不会被过滤
+        if created and self.event_bus_running:
+            await asyncio.to_thread(self._acquire_targets, created)
+
         await self.send_personal_message(client_id, {
             "type": "SUBSCRIBE_CONFIRM",
             "subscribed_targets": target_ids,
@@ -74,57 +140,424 @@ class ConnectionManager:
 
     async def unsubscribe_targets(self, client_id: str, target_ids: List[str]):
         """取消订阅"""
+        emptied = []
         for tid in target_ids:
-            if tid in self.target_subscriptions:
-                self.target_subscriptions[tid].discard(client_id)
+            if self._leave_room(tid, client_id):
+                emptied.append(tid)
             if client_id in self.client_subscriptions:
                 self.client_subscriptions[client_id].discard(tid)
 
+        if emptied and self.event_bus_running:
+            await asyncio.to_thread(self._release_targets, emptied)
+
+    def _leave_room(self, target_id: str, client_id: str) -> bool:
+        """将连接移出目标房间，房间为空时删除并返回True"""
+        room = self.target_subscriptions.get(target_id)
+        if room is None:
+            return False
+        room.discard(client_id)
+        if not room:
+            del self.target_subscriptions[target_id]
+            return True
+        return False
+
+    @property
+    def _release_script(self):
+        """订阅释放脚本（首次使用时注册）"""
+        if self._release_script_obj is None:
+            self._release_script_obj = redis_client.client.register_script(_RELEASE_SUBSCRIPTIONS_SCRIPT)
+        return self._release_script_obj
+
+    def _acquire_targets(self, target_ids: List[str]):
+        """本进程开始订阅目标：集群订阅表计数加1"""
+        try:
+            pipe = redis_client.client.pipeline(transaction=False)
+            for tid in target_ids:
+                pipe.hincrby(self.subscription_key, tid, 1)
+            pipe.execute()
+        except Exception as e:
+            logger.error(f"写入集群订阅表失败: {e}")
+
+    def _release_targets(self, target_ids: List[str]):
+        """本进程不再订阅目标：集群订阅表计数减1"""
+        try:
+            self._release_script(keys=[self.subscription_key], args=list(target_ids))
+        except Exception as e:
+            logger.error(f"释放集群订阅表失败: {e}")
+
+    async def receive(self, client_id: str) -> dict:
+        """
+        接收客户端消息
+
+        文本帧按JSON解析；二进制帧首字节为 '{' 时按JSON解析，否则按msgpack解析，
+        并将该连接的后续推送切换为msgpack二进制帧
+        """
+        websocket = self.active_connections[client_id]
+        message = await websocket.receive()
+
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+
+        if message.get("text") is not None:
+            return orjson.loads(message["text"])
+
+        data = message.get("bytes") or b""
+        if data[:1] == b"{":
+            return orjson.loads(data)
+
+        self.binary_clients.add(client_id)
+        return msgpack.unpackb(data, raw=False)
+
+    def _encode_for(self, client_id: str, message: dict) -> Union[str, bytes]:
+        """按连接的通信格式编码消息"""
+        if client_id in self.binary_clients:
+            return _pack(message)
+        return orjson.dumps(message, option=_ORJSON_OPTIONS).decode()
+
+    @staticmethod
+    async def _send_encoded(connection: WebSocket, frame: Union[str, bytes]):
+        """发送已编码的帧（bytes为二进制帧，str为文本帧）"""
+        if isinstance(frame, bytes):
+            await connection.send_bytes(frame)
+        else:
+            await connection.send_text(frame)
+
     async def send_personal_message(self, client_id: str, message: dict):
         """发送个人消息"""
         if client_id in self.active_connections:
             try:
-                await self.active_connections[client_id].send_json(message)
+                await self._send_encoded(
+                    self.active_connections[client_id],
+                    self._encode_for(client_id, message)
+                )
             except Exception as e:
                 logger.error(f"发送消息失败 [{client_id}]: {e}")
 
-    async def broadcast(self, message: dict):
-        """广播消息"""
-        disconnected = []
-        for client_id, connection in self.active_connections.items():
-            try:
-                await connection.send_json(message)
-            except Exception:
-                disconnected.append(client_id)
+    async def broadcast(self, message: dict, client_ids: Optional[Iterable[str]] = None):
+        """
+        广播消息
+
+        每种通信格式只序列化一次，同格式的连接复用同一帧数据
+
+        Args:
+            message: 消息内容
+            client_ids: 接收者列表（None表示全部连接）
+        """
+        await self._send_frame(message, client_ids)
+
+    async def _send_frame(self, message: dict, client_ids: Optional[Iterable[str]] = None):
+        """向本进程内的连接发送消息（JSON文本帧与msgpack二进制帧各最多编码一次）"""
+        if client_ids is None:
+            recipients = list(self.active_connections.items())
+        else:
+            recipients = [(cid, self.active_connections[cid])
+                          for cid in client_ids if cid in self.active_connections]
+
+        if not recipients:
+            return
+
+        text = packed = None
+        sends = []
+        for cid, connection in recipients:
+            if cid in self.binary_clients:
+                if packed is None:
+                    packed = _pack(message)
+                sends.append(connection.send_bytes(packed))
+            else:
+                if text is None:
+                    text = orjson.dumps(message, option=_ORJSON_OPTIONS).decode()
+                sends.append(connection.send_text(text))
+
+        results = await asyncio.gather(*sends, return_exceptions=True)
 
         # 清理断开的连接
-        for cid in disconnected:
-            self.disconnect(cid)
+        for (cid, _), result in zip(recipients, results):
+            if isinstance(result, Exception):
+                self.disconnect(cid)
 
-    async def notify_target_update(self, target_id: str, delta: dict):
-        """通知目标更新"""
-        if target_id not in self.target_subscriptions:
+    async def _dispatch(self, events: List[Tuple[str, dict]]):
+        """
+        按订阅关系推送到本进程连接
+
+        单个事件保持原消息格式；多个事件按接收者合并为一帧 BATCH 消息，
+        接收事件集合相同的连接共用同一帧
+
+        Args:
+            events: [(target_id, message)]，target_id为空表示广播
+        """
+        if len(events) == 1:
+            target_id, message = events[0]
+            if not target_id:
+                await self._send_frame(message)
+            elif target_id in self.target_subscriptions:
+                await self._send_frame(message, list(self.target_subscriptions[target_id]))
+            return
+
+        # {client_id: [事件下标]}：按目标房间展开，只访问各事件的订阅者
+        client_events: Dict[str, List[int]] = {}
+        for i, (target_id, _) in enumerate(events):
+            if target_id:
+                recipients = self.target_subscriptions.get(target_id, ())
+            else:
+                recipients = self.active_connections
+            for client_id in recipients:
+                client_events.setdefault(client_id, []).append(i)
+
+        # {事件下标元组: [client_id]}
+        groups: Dict[Tuple[int, ...], List[str]] = {}
+        for client_id, indexes in client_events.items():
+            groups.setdefault(tuple(indexes), []).append(client_id)
+
+        await asyncio.gather(*(
+            self._send_frame(self._batch_message([events[i][1] for i in indexes]), client_ids)
+            for indexes, client_ids in groups.items()
+        ))
+
+    def _batch_message(self, messages: List[dict]) -> dict:
+        """构建合并消息（只有一个事件时保持原消息格式）"""
+        if len(messages) == 1:
+            return messages[0]
+        return {
+            "type": "BATCH",
+            "events": messages,
+            "timestamp": datetime.now().isoformat()
+        }
+
+    async def publish(self, message: dict, target_id: Optional[str] = None):
+        """
+        发布事件
+
+        合并推送开启时先进入缓冲区，由刷新任务定时批量发出；否则立即发出
+
+        Args:
+            message: 消息内容
+            target_id: 目标ID（仅推送给该目标的订阅者），None表示广播
+        """
+        if self.flush_running:
+            self._pending.append((target_id or "", message))
+            return
+
+        await self._publish_events([(target_id or "", message)])
+
+    async def _publish_events(self, events: List[Tuple[str, dict]]):
+        """
+        发出一组事件
+
+        事件总线运行时写入Redis Stream，由各进程的监听任务推送给本地连接；
+        否则直接推送给本进程连接
+        """
+        if self.event_bus_running:
+            entry_id = await asyncio.to_thread(
+                redis_client.xadd,
+                self.event_stream,
+                {"events": orjson.dumps(events, option=_ORJSON_OPTIONS)},
+                RedisConfig.EVENT_STREAM_MAXLEN
+            )
+            if entry_id:
+                return
+            logger.warning("事件总线写入失败，改为本地推送")
+
+        await self._dispatch(events)
+
+    @property
+    def flush_running(self) -> bool:
+        """合并推送任务是否运行"""
+        return self._flush_task is not None and not self._flush_task.done()
+
+    def start_flush_loop(self):
+        """启动合并推送任务（需在事件循环中调用）"""
+        if self.flush_interval <= 0 or self.flush_running:
+            return
+        self._flush_task = asyncio.create_task(self._flush_loop())
+        logger.info(f"WebSocket合并推送已启动，间隔{self.flush_interval * 1000:.0f}ms")
+
+    async def stop_flush_loop(self):
+        """停止合并推送任务，并发出缓冲区中剩余事件"""
+        if self._flush_task is None:
+            return
+        self._flush_task.cancel()
+        try:
+            await self._flush_task
+        except asyncio.CancelledError:
+            pass
+        self._flush_task = None
+        await self._flush()
+
+    async def _flush(self):
+        """发出缓冲区中的全部事件"""
+        if not self._pending:
+            return
+        events, self._pending = self._pending, []
+        await self._publish_events(events)
+
+    async def _flush_loop(self):
+        """合并推送循环"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self._flush()
+            except Exception as e:
+                logger.error(f"合并推送失败: {e}")
+
+    @property
+    def event_bus_running(self) -> bool:
+        """事件总线是否运行"""
+        return self._event_bus_task is not None and not self._event_bus_task.done()
+
+    def start_event_bus(self):
+        """启动事件总线监听（需在事件循环中调用）"""
+        if self.event_bus_running:
+            return
+        self._event_bus_task = asyncio.create_task(self._event_bus_loop())
+
+        # 总线启动前已存在的房间补登记到集群订阅表
+        if self.target_subscriptions:
+            asyncio.create_task(
+                asyncio.to_thread(self._acquire_targets, list(self.target_subscriptions))
+            )
+        logger.info(f"WebSocket事件总线已启动 [{self.event_stream}]")
+
+    async def stop_event_bus(self):
+        """停止事件总线监听"""
+        if self._event_bus_task is None:
+            return
+        self._event_bus_task.cancel()
+        try:
+            await self._event_bus_task
+        except asyncio.CancelledError:
+            pass
+        self._event_bus_task = None
+
+        # 本进程退出订阅，避免集群订阅表残留计数
+        if self.target_subscriptions:
+            await asyncio.to_thread(self._release_targets, list(self.target_subscriptions))
+        logger.info("WebSocket事件总线已停止")
+
+    def _latest_event_id(self) -> str:
+        """获取事件流当前最新ID（从此之后开始消费）"""
+        entries = redis_client.client.xrevrange(self.event_stream, count=1)
+        return entries[0][0] if entries else "0-0"
+
+    async def _event_bus_loop(self):
+        """事件总线监听循环：阻塞读取Redis Stream并推送给本地连接"""
+        last_id = None
+
+        while True:
+            try:
+                if last_id is None:
+                    last_id = await asyncio.to_thread(self._latest_event_id)
+
+                results = await asyncio.to_thread(
+                    redis_client.client.xread,
+                    {self.event_stream: last_id},
+                    count=100,
+                    block=RedisConfig.EVENT_READ_BLOCK_MS
+                )
+
+                for _, entries in results or []:
+                    for entry_id, fields in entries:
+                        last_id = entry_id
+                        events = orjson.loads(redis_client._deserialize(fields[b"events"]))
+                        await self._dispatch([tuple(e) for e in events])
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"事件总线读取失败: {e}")
+                await asyncio.sleep(1)
+
+    def emit(self, message: dict, target_id: Optional[str] = None):
+        """
+        发布事件（同步调用，不等待发送）
+
+        合并推送开启时直接进入缓冲区，否则创建后台发送任务
+        """
+        if self.flush_running:
+            self._pending.append((target_id or "", message))
             return
 
-        message = {
+        asyncio.get_event_loop().create_task(
+            self._publish_events([(target_id or "", message)])
+        )
+
+    def _cluster_subscribed(self, target_ids: List[str]) -> Set[str]:
+        """查询集群订阅表，返回存在订阅者的目标（查询失败时视为全部存在）"""
+        try:
+            counts = redis_client.client.hmget(self.subscription_key, target_ids)
+        except Exception as e:
+            logger.error(f"查询集群订阅表失败: {e}")
+            return set(target_ids)
+        return {tid for tid, count in zip(target_ids, counts) if count is not None}
+
+    async def _subscribed_targets(self, target_ids: List[str]) -> Set[str]:
+        """
+        过滤出存在订阅者的目标
+
+        本进程房间直接命中；事件总线运行时其余目标按集群订阅表判断
+        """
+        subscribed = {tid for tid in target_ids if tid in self.target_subscriptions}
+        if not self.event_bus_running:
+            return subscribed
+
+        remote = [tid for tid in target_ids if tid not in subscribed]
+        if remote:
+            subscribed |= await asyncio.to_thread(self._cluster_subscribed, remote)
+        return subscribed
+
+    def _target_update_message(self, target_id: str, delta: dict) -> dict:
+        return {
             "type": "TARGET_UPDATE",
             "target_id": target_id,
             "delta": delta,
             "timestamp": datetime.now().isoformat()
         }
 
-        # 只通知订阅者
-        for client_id in list(self.target_subscriptions[target_id]):
-            await self.send_personal_message(client_id, message)
-
-    async def notify_formation_detected(self, formation_data: dict):
-        """通知新编队识别"""
-        message = {
+    def _formation_detected_message(self, formation_data: dict) -> dict:
+        return {
             "type": "FORMATION_DETECTED",
             "formation": formation_data,
             "timestamp": datetime.now().isoformat()
         }
-        await self.broadcast(message)
+
+    async def notify_target_update(self, target_id: str, delta: dict):
+        """通知目标更新"""
+        if not await self._subscribed_targets([target_id]):
+            return
+
+        # 只通知订阅者
+        await self.publish(self._target_update_message(target_id, delta), target_id)
+
+    async def notify_formation_detected(self, formation_data: dict):
+        """通知新编队识别"""
+        await self.publish(self._formation_detected_message(formation_data))
+
+    async def broadcast_targets(self, updates: List[Tuple[str, dict]]):
+        """
+        批量通知目标更新
+
+        整批作为一组事件发出，按订阅者分组后每组只编码一帧
+
+        Args:
+            updates: [(target_id, delta)]
+        """
+        subscribed = await self._subscribed_targets([tid for tid, _ in updates])
+        events = [
+            (tid, self._target_update_message(tid, delta))
+            for tid, delta in updates
+            if tid in subscribed
+        ]
+        if not events:
+            return
+
+        if self.flush_running:
+            self._pending.extend(events)
+            return
+
+        await self._publish_events(events)
+
+    def emit_formation_detected(self, formation_data: dict):
+        """通知新编队识别（同步调用）"""
+        self.emit(self._formation_detected_message(formation_data))
 
 
 # 全局连接管理器